@@ -1,27 +1,320 @@
+from time import perf_counter
+_IMPORT_START = perf_counter()
+
+import gzip
+import hashlib
+import heapq
 import os
+import pickle
+import zlib
+from array import array
+from collections import Counter, OrderedDict, deque
+from difflib import SequenceMatcher
+from random import uniform
 from time import time
-from asyncio import wait_for, TimeoutError
+from asyncio import sleep, shield, wait_for, CancelledError, TimeoutError
 from concurrent.futures import ThreadPoolExecutor
-from functools import partial
-from nationstates import Api, Shard
-from nationstates.NScore.exceptions import NotFound, RateLimitCatch
+from itertools import count
+from threading import Lock
+from urllib.parse import quote
 
 import discord
 from discord.ext import commands
 
 from cogs.utils import checks
 from .utils.dataIO import dataIO
+from .utils.chat_formatting import box
+
+_IMPORT_TIME = perf_counter() - _IMPORT_START
 
 
 executor = ThreadPoolExecutor(max_workers=1)
+# Large, rarely changing text shards that api_texts serves from the store
+TEXT_SHARDS = {"factbook", "dispatch"}
+# APIs whose value is a nation or region name
+NAMED = {"nation", "region"}
+API_URL = "https://www.nationstates.net/cgi-bin/api.cgi?"
+# Bytes read at a time by api_raw
+CHUNK = 64 * 1024
+# QUOTAS are [requests per minute, burst] for each user and each server;
+# WEIGHTS are servers' shares of the rate limit when it runs short
+DEFAULTS = {"AGENT": None, "QUOTAS": {"USER": [12, 8], "SERVER": [30, 20]},
+            "WEIGHTS": {}}
+
+
+class NameNotFound(ValueError):
+    """Raised by NSApi.api for nations and regions that don't exist
+
+    suggestions holds the canonical names of up to three known nations or
+    regions similar to the one requested."""
+
+    def __init__(self, kind: str, name: str, suggestions=()):
+        super().__init__("{} {} does not exist".format(kind.title(), name))
+        self.kind = kind
+        self.name = name
+        self.suggestions = list(suggestions)
+
+
+class NameIndex:
+    """Trigram index of the known names of one kind, for suggestions
+
+    Names are held as interned IDs, which are also saved to a file as they
+    become known. Each trigram of a name, padded with "$" on both ends, maps
+    to an array of the IDs of names containing it; the trigrams are only
+    built when the first suggestion is needed."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.ids = array("I")
+        try:
+            with open(path, "rb") as file:
+                self.ids.frombytes(file.read())
+        except FileNotFoundError:
+            pass
+        self.known = set(self.ids)
+        self.trigrams = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def add(self, ids, names):
+        """Adds the IDs not yet known, with their names"""
+        new = array("I")
+        for id, name in zip(ids, names):
+            if id in self.known:
+                continue
+            self.known.add(id)
+            new.append(id)
+            if self.trigrams is not None:
+                self._index(id, name)
+        if new:
+            self.ids.extend(new)
+            with open(self.path, "ab") as file:
+                new.tofile(file)
+
+    def build(self, ids, names):
+        """Returns the trigrams of the given IDs, for assigning to trigrams
+
+        Slow for the whole world, so it's done without holding any lock."""
+        trigrams = {}
+        for id, name in zip(ids, names):
+            for trigram in _trigrams(name):
+                try:
+                    trigrams[trigram].append(id)
+                except KeyError:
+                    trigrams[trigram] = array("I", (id,))
+        return trigrams
+
+    def candidates(self, name: str, count: int):
+        """Returns the IDs sharing the most trigrams with a name"""
+        shared = Counter()
+        for trigram in _trigrams(name):
+            shared.update(self.trigrams.get(trigram, ()))
+        return heapq.nlargest(count, shared, key=shared.__getitem__)
+
+    def _index(self, id, name):
+        for trigram in _trigrams(name):
+            try:
+                self.trigrams[trigram].append(id)
+            except KeyError:
+                self.trigrams[trigram] = array("I", (id,))
+
+
+class TextStore:
+    """Compressed, content-addressed store for large text shards
+
+    Texts are kept zlib-compressed under their SHA-1 digest, in one file
+    each on disk and in memory up to max_bytes, and are only decompressed
+    when read. Keys such as "region:the_pacific:factbook" map to a digest
+    and the time it was stored, so identical texts are only kept once. Keys
+    not stored again for retention seconds are dropped by expire."""
+
+    def __init__(self, folder: str, max_bytes: int=8 * 2 ** 20,
+                 retention: float=30 * 86400):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.retention = retention
+        # Most recently used last
+        self._blobs = OrderedDict()
+        self._size = 0
+        self.dirty = False
+        self._index = os.path.join(folder, "index.json")
+        if dataIO.is_valid_json(self._index):
+            self._keys = dataIO.load_json(self._index)
+        else:
+            self._keys = {}
+
+    def get(self, key: str, max_age: float=None):
+        """Returns the text stored under a key, or None
+
+        None is also returned if the text was stored over max_age seconds
+        ago."""
+        try:
+            digest, stored = self._keys[key]
+        except KeyError:
+            return None
+        if max_age is not None and time() - stored > max_age:
+            return None
+        blob = self._blobs.get(digest)
+        if blob is None:
+            try:
+                with open(self._path(digest), "rb") as file:
+                    blob = file.read()
+            except FileNotFoundError:
+                del self._keys[key]
+                self.dirty = True
+                return None
+        self._cache(digest, blob)
+        return zlib.decompress(blob).decode()
+
+    def put(self, key: str, text: str) -> str:
+        """Stores a text under a key and returns its digest"""
+        data = text.encode()
+        digest = hashlib.sha1(data).hexdigest()
+        old = self._keys.get(key)
+        self._keys[key] = [digest, time()]
+        self.dirty = True
+        if old and old[0] == digest:
+            return digest
+        blob = self._blobs.get(digest)
+        if blob is None:
+            blob = zlib.compress(data, 9)
+            if not os.path.exists(self._path(digest)):
+                with open(self._path(digest), "wb") as file:
+                    file.write(blob)
+        self._cache(digest, blob)
+        if old and all(old[0] != value[0] for value in self._keys.values()):
+            self._forget(old[0])
+        return digest
+
+    def expire(self) -> list:
+        """Drops keys older than retention
+
+        Returns the digests no longer stored under any key; their files can
+        then be removed with remove."""
+        cutoff = time() - self.retention
+        old = {key for key, (_, stored) in self._keys.items()
+               if stored < cutoff}
+        if not old:
+            return []
+        digests = {self._keys.pop(key)[0] for key in old}
+        digests.difference_update(digest for digest, _ in self._keys.values())
+        for digest in digests:
+            self._blobs.pop(digest, None)
+        self._size = sum(map(len, self._blobs.values()))
+        self.dirty = True
+        return list(digests)
+
+    def snapshot(self) -> dict:
+        """Returns a copy of the keys to save with save, and clears dirty"""
+        self.dirty = False
+        return {key: list(value) for key, value in self._keys.items()}
+
+    def save(self, keys: dict, removed=()):
+        """Writes a snapshot of the keys and removes expired texts' files
+
+        Safe to call from executor threads."""
+        dataIO.save_json(self._index, keys)
+        for digest in removed:
+            try:
+                os.remove(self._path(digest))
+            except FileNotFoundError:
+                pass
+
+    def _cache(self, digest, blob):
+        if digest in self._blobs:
+            self._blobs.move_to_end(digest)
+            return
+        self._blobs[digest] = blob
+        self._size += len(blob)
+        while self._size > self.max_bytes and len(self._blobs) > 1:
+            self._size -= len(self._blobs.popitem(last=False)[1])
+
+    def _forget(self, digest):
+        blob = self._blobs.pop(digest, None)
+        if blob is not None:
+            self._size -= len(blob)
+        try:
+            os.remove(self._path(digest))
+        except FileNotFoundError:
+            pass
+
+    def _path(self, digest):
+        return os.path.join(self.folder, digest + ".z")
 
 
 class NSApi:
 
     def __init__(self, bot):
         self.bot = bot
-        self.settings = dataIO.load_json("data/nsapi/settings.json")
-        self._api = Api()
+        self.settings = {"AGENT": None}
+        # nationstates (and requests, bs4, xmltodict with it) is only
+        # imported once the first request is made
+        self._api = None
+        # Interned nation and region names; IDs are the line numbers of
+        # data/nsapi/names.txt, so they are stable across reloads and cogs
+        self._ids = None
+        self._names = None
+        self._names_lock = Lock()
+        # Known nation and region names, and ones confirmed not to exist,
+        # so that typos can be answered without a request
+        self._known = None
+        self._missing = {}
+        self.missing_ttl = 6 * 3600
+        self.texts = None
+        self.text_ttl = 3600
+        # Adaptive timeouts, retries and circuit breaker
+        self.min_timeout = 3.
+        self.max_timeout = 15.
+        self.retries = 2
+        self.failure_threshold = 5
+        self.open_time = 60
+        self._latencies = deque(maxlen=200)
+        self._failures = 0
+        self._open_until = None
+        self._probing = False
+        # A timed out request still holding the executor's only thread
+        self._stuck = None
+        # HTTP status of the last response, set from the executor
+        self._status = None
+        # Last response for each distinct request, pickled, served while the
+        # breaker is open; bounded by the total size of the pickles
+        self._responses = OrderedDict()
+        self._responses_size = 0
+        self.responses_bytes = 4 * 2 ** 20
+        # Keys of prefetched responses, and when they stop being served
+        self._warm = {}
+        self.warm_ttl = 600
+        # (api, value, phase, seconds) of each phase of each request, and
+        # of formatting responses, while this is a list; NSProfile sets it
+        # while profiling
+        self.phase_log = None
+        # Fair sharing of the rate limit: token buckets of [tokens, last
+        # refill] by user and server ID, and a weighted fair queue of
+        # (background, virtual finish, order, future) for when the rate
+        # limit runs short
+        self._buckets = {"USER": {}, "SERVER": {}}
+        self._queue = []
+        self._order = count()
+        self._finish = {}
+        self._virtual = 0.
+        self._dispatcher = None
+        self._sending = 0
+        # When api_raw's requests were sent, as nationstates doesn't see them
+        self._raw_sent = deque()
+        # Requests left free for commands by background work
+        self.background_reserve = 10
+        # (time, server ID, user ID, background) of the last hour's requests
+        self._usage = deque()
+        self._throttled = Counter()
+        self.startup = {}
+        self._loading = bot.loop.run_in_executor(None, self._load)
+        self._saver = bot.loop.create_task(self._save_loop())
+
+    def __unload(self):
+        self._saver.cancel()
+        if self.texts is not None and self.texts.dirty:
+            self.texts.save(self.texts.snapshot(), self.texts.expire())
 
     @commands.command(pass_context=True)
     @checks.is_owner()
@@ -32,6 +325,7 @@ class NSApi:
         Use an informative agent, like an email address, nation name, or both.
         Contact the cog creator (and unload this cog) if you get any relevant
         emails or telegrams."""
+        await self._loading
         if not agent:
             await self.bot.whisper("```User agent: {}```".format(
                 self.settings["AGENT"]))
@@ -42,67 +336,910 @@ class NSApi:
             await self.bot.say("```New user agent: {}```".format(
                 self.settings["AGENT"]))
 
+    @commands.command()
+    @checks.is_owner()
+    # API requests: 0; non-API requests: 0
+    async def nsstartup(self):
+        """Shows how long each loaded NS cog took to import and set up
+
+        "data" and "client" are deferred until after setup, so they do not
+        count towards the time the bot spends blocked loading the cog."""
+        lines = []
+        for name, cog in sorted(self.bot.cogs.items()):
+            startup = getattr(cog, "startup", None)
+            if startup is None:
+                continue
+            lines.append("{:<12} {}".format(name, " | ".join(
+                "{}: {:.1f}ms".format(phase, 1e3 * startup[phase])
+                for phase in ("import", "setup", "data", "client")
+                if phase in startup)))
+        await self.bot.say(box("\n".join(lines)))
+
+    @commands.command()
+    @checks.is_owner()
+    # API requests: 0; non-API requests: 0
+    async def nsstatus(self):
+        """Shows NationStates API health as seen by the bot"""
+        if self._open_until is None:
+            state = "Closed (healthy)"
+        elif self._probing:
+            state = "Half-open (probing)"
+        else:
+            state = "Open, retrying in {:.0f}s".format(
+                max(0., self._open_until - time()))
+        latencies = sorted(self._latencies)
+        with self._names_lock:
+            if self._known is None:
+                self._read_known()
+            known = {kind: len(index) for kind, index in self._known.items()}
+            now = time()
+            missing = sum(1 for expires in self._missing.values()
+                          if expires > now)
+        await self.bot.say(box(
+            "Circuit breaker: {}\n"
+            "Consecutive failures: {}\n"
+            "Latency p50/p95/p99: {}\n"
+            "Timeout: {:.1f}s\n"
+            "Rate limit budget: {} requests ({} queued)\n"
+            "Cached responses: {} ({:.1f} MiB)\n"
+            "Known names: {} nations, {} regions\n"
+            "Names known not to exist: {}".format(
+                state, self._failures, " / ".join(
+                    "{:.2f}s".format(latencies[int(q * (len(latencies) - 1))])
+                    for q in (0.5, 0.95, 0.99)) if latencies else "n/a",
+                self._timeout(), self.budget(), len(self._queue),
+                len(self._responses), self._responses_size / 2 ** 20,
+                known["nation"], known["region"], missing)))
+
+    @commands.group(pass_context=True)
+    @checks.is_owner()
+    # API requests: 0; non-API requests: 0
+    async def nsquota(self, ctx):
+        """Shows or sets the shares of the API rate limit
+
+        Each user and each server may make a number of requests per minute,
+        with short bursts above it. When the rate limit runs short, servers
+        take turns in proportion to their weight, and commands go before
+        background work."""
+        if ctx.invoked_subcommand is not None:
+            return
+        await self._loading
+        quotas = self.settings["QUOTAS"]
+        await self.bot.say(box(
+            "Per user: {} requests/minute, bursts of {}\n"
+            "Per server: {} requests/minute, bursts of {}\n"
+            "Weights: {}".format(*quotas["USER"] + quotas["SERVER"] + [
+                ", ".join("{} {}".format(self._server_name(id), weight)
+                          for id, weight in self.settings["WEIGHTS"].items())
+                or "all 1"])))
+        await self.bot.send_cmd_help(ctx)
+
+    @nsquota.command(name="user")
+    # API requests: 0; non-API requests: 0
+    async def _nsquota_user(self, per_minute: int, burst: int):
+        """Sets how many requests each user may make"""
+        await self._set_quota("USER", per_minute, burst)
+
+    @nsquota.command(name="server")
+    # API requests: 0; non-API requests: 0
+    async def _nsquota_server(self, per_minute: int, burst: int):
+        """Sets how many requests each server may make"""
+        await self._set_quota("SERVER", per_minute, burst)
+
+    @nsquota.command(name="weight", pass_context=True)
+    # API requests: 0; non-API requests: 0
+    async def _nsquota_weight(self, ctx, weight: float, server_id=None):
+        """Sets a server's share of the rate limit when it runs short
+
+        Defaults to this server. Servers have a weight of 1 unless set."""
+        if weight <= 0:
+            return await self.bot.say("The weight must be positive.")
+        server_id = server_id or (ctx.message.server and ctx.message.server.id)
+        if server_id is None:
+            return await self.bot.say("Give a server ID.")
+        await self._loading
+        if weight == 1:
+            self.settings["WEIGHTS"].pop(server_id, None)
+        else:
+            self.settings["WEIGHTS"][server_id] = weight
+        dataIO.save_json("data/nsapi/settings.json", self.settings)
+        await self.bot.say("{} now has a weight of {:g}.".format(
+            self._server_name(server_id), weight))
+
+    @commands.command()
+    @checks.is_owner()
+    # API requests: 0; non-API requests: 0
+    async def nsusage(self):
+        """Shows who made the API requests of the last hour"""
+        self._prune_usage()
+        if not self._usage:
+            return await self.bot.say("No requests in the last hour.")
+        servers, users = Counter(), Counter()
+        background = tasks = 0
+        for _, server, user, bg in self._usage:
+            if bg:
+                background += 1
+            if user is None:
+                # Not made for any command
+                tasks += 1
+                continue
+            servers[server] += 1
+            if not bg:
+                users[(server, user)] += 1
+        total = len(self._usage)
+        lines = ["{} requests, {} in the background ({} by periodic "
+                 "tasks)".format(total, background, tasks), "", "Servers:"]
+        lines.extend("{:>5} {:>4.0%}  {}".format(
+            used, used / total, self._server_name(server))
+            for server, used in servers.most_common(10))
+        lines.extend(("", "Users:"))
+        lines.extend("{:>5} {:>4.0%}  {} ({}){}".format(
+            used, used / total, self._user_name(server, user),
+            self._server_name(server), ", throttled {} times".format(
+                self._throttled[user]) if self._throttled[user] else "")
+            for (server, user), used in users.most_common(10))
+        await self.bot.say(box("\n".join(lines)))
+
     def check_agent(self):
+        if not self._loading.done():
+            # The request methods wait for the settings, then check again
+            return
+        self._loading.result()
         if not self.settings["AGENT"]:
             raise RuntimeError(
                 "User agent is not yet set! Set it with \"[p]agent\" first.")
 
     def shard(self, shard: str, **kwargs):
-        return Shard(shard, **kwargs)
+        # Converted to a nationstates.Shard in the executor, so that building
+        # a request doesn't import nationstates on the event loop
+        return (shard, tuple(sorted(kwargs.items())))
+
+    @staticmethod
+    def canonical(name: str) -> str:
+        """Returns the canonical form of a nation or region name
+
+        Surrounding whitespace and quotes are dropped, and the name is
+        lowercased with spaces replaced by underscores, as in NationStates
+        IDs and URLs."""
+        return str(name).strip().strip("\"").strip().lower().replace(
+            " ", "_")
+
+    def intern_id(self, name: str) -> int:
+        """Returns the stable integer ID of a nation or region name"""
+        return self.intern_ids((name,))[0]
+
+    def intern_ids(self, names) -> list:
+        """Returns the stable integer IDs of many nation or region names
+
+        Safe to call from executor threads."""
+        with self._names_lock:
+            if self._ids is None:
+                self._read_names()
+            ids = []
+            new = []
+            for name in names:
+                name = self.canonical(name)
+                try:
+                    ids.append(self._ids[name])
+                except KeyError:
+                    self._ids[name] = len(self._names)
+                    ids.append(len(self._names))
+                    self._names.append(name)
+                    new.append(name)
+            if new:
+                with open("data/nsapi/names.txt", "a") as file:
+                    file.write("".join(name + "\n" for name in new))
+            return ids
+
+    def known_id(self, name: str):
+        """Returns the ID of a name if it has already been interned, or None
+
+        Unlike intern_id, this never adds the name to the table."""
+        with self._names_lock:
+            if self._ids is None:
+                self._read_names()
+            return self._ids.get(self.canonical(name))
+
+    def learn(self, kind: str, names) -> list:
+        """Interns names and records them as known nations or regions
 
-    async def api(self, *shards, **kwargs):
+        kind is "nation" or "region". Known names are what suggestions are
+        drawn from. Returns the IDs, like intern_ids; safe to call from
+        executor threads."""
+        names = [self.canonical(name) for name in names]
+        ids = self.intern_ids(names)
+        with self._names_lock:
+            if self._known is None:
+                self._read_known()
+            self._known[kind].add(ids, names)
+            for name in names:
+                self._missing.pop((kind, name), None)
+        return ids
+
+    def suggest(self, kind: str, name: str, count: int=3) -> list:
+        """Returns up to count known names of a kind similar to a name
+
+        The first call builds the trigram index, which can take a few
+        seconds with a whole nations dump learnt; run it in an executor."""
+        name = self.canonical(name)
+        with self._names_lock:
+            if self._known is None:
+                self._read_known()
+            if self._names is None:
+                self._read_names()
+            index = self._known[kind]
+            ids = index.ids[:]
+        if index.trigrams is None:
+            trigrams = index.build(ids, self.id_names(ids))
+            with self._names_lock:
+                if index.trigrams is None:
+                    # Add whatever was learnt while building
+                    index.trigrams = trigrams
+                    for id in index.ids[len(ids):]:
+                        index._index(id, self._names[id])
+        with self._names_lock:
+            candidates = index.candidates(name, 20)
+            names = [self._names[id] for id in candidates]
+        scored = [(SequenceMatcher(None, name, known).ratio(), known)
+                  for known in names if known != name]
+        return [known for score, known in sorted(scored, reverse=True)
+                if score >= 0.6][:count]
+
+    def id_name(self, id: int) -> str:
+        """Returns the nation or region name of an interned ID"""
+        return self.id_names((id,))[0]
+
+    def id_names(self, ids) -> list:
+        with self._names_lock:
+            if self._names is None:
+                self._read_names()
+            return [self._names[id] for id in ids]
+
+    async def api_texts(self, *shards, ctx=None, **kwargs):
+        """Like api, but serves large text shards from the text store
+
+        Text shards stored less than text_ttl seconds ago are not fetched
+        again; if every requested shard is stored, no request is made."""
+        await self._loading
+        self.check_agent()
+        api, value = next(iter(kwargs.items()), ("world", None))
+        if value is not None:
+            value = self.canonical(value)
+        stored, keys, rest = {}, {}, []
+        for shard in shards:
+            name = (shard[0] if isinstance(shard, tuple) else shard).lower()
+            if name not in TEXT_SHARDS:
+                rest.append(shard)
+                continue
+            keys[name] = "{}:{}:{}{}".format(
+                api, value, name, "".join(
+                    ":{}={}".format(*param) for param in shard[1])
+                if isinstance(shard, tuple) else "")
+            text = self.texts.get(keys[name], self.text_ttl)
+            if text is None:
+                rest.append(shard)
+            else:
+                stored[name] = text
+        if rest:
+            data = await self.api(*rest, ctx=ctx, **kwargs)
+        else:
+            data = {} if value is None else {"id": value}
+        for name, key in keys.items():
+            if name not in stored and isinstance(data.get(name), str):
+                self.texts.put(key, data[name])
+        data.update(stored)
+        return data
+
+    async def api_raw(self, path: str, *shards, compress: bool=False,
+                      ctx=None, background: bool=False, **kwargs) -> int:
+        """Streams the raw XML response to a request into a file at path
+
+        Nothing is parsed or kept in memory, however large the response.
+        With compress, the file is gzipped; if NationStates already sent it
+        gzipped, it is written out as it came. Quotas apply as with api.
+        Returns the size of the file."""
+        await self._loading
+        self.check_agent()
+        if len(kwargs) > 1:
+            raise TypeError("Multiple **kwargs: {}".format(kwargs))
+        api, value = next(iter(kwargs.items()), ("world", None))
+        api = "wa" if api == "council" else api
+        if api not in ("world", "wa") and api not in NAMED:
+            raise TypeError("Unexpected **kwargs: {}".format(kwargs))
+        if api in NAMED:
+            value = self.canonical(value)
+            missing = self._missing.get((api, value))
+            if missing is not None and time() < missing:
+                raise await self._not_found(api, value)
+        query, names = [], []
+        for shard in shards:
+            if isinstance(shard, tuple):
+                names.append(shard[0])
+                query.extend(shard[1])
+            else:
+                names.append(shard)
+        query = ([(api, value)] if value is not None else []) + [
+            ("q", "+".join(names))] + query + [("v", "9")]
+        url = API_URL + "&".join("{}={}".format(key, quote(str(param),
+                                                           safe="+"))
+                                 for key, param in query)
+        server = ctx and ctx.message.server and ctx.message.server.id
+        if ctx is not None and not background and \
+                not checks.is_owner_check(ctx):
+            self._charge(server, ctx.message.author.id)
+        await self._turn(server, background)
+        self._usage.append((time(), server, ctx and ctx.message.author.id,
+                            background))
+        self._prune_usage()
+        self._raw_sent.append(time())
+        # Not the nationstates executor, so large downloads don't hold up
+        # other requests
+        status, retry_after, size = await self.bot.loop.run_in_executor(
+            None, _stream, url, self.settings["AGENT"], path, compress)
+        if status == 404:
+            if api not in NAMED:
+                raise ValueError("Not found: {}".format(url))
+            self._missing[(api, value)] = time() + self.missing_ttl
+            raise await self._not_found(api, value)
+        if status == 429:
+            raise commands.CommandOnCooldown(30, float(retry_after or 30))
+        if status != 200:
+            raise RuntimeError("NationStates returned HTTP {} for {}".format(
+                status, url))
+        return size
+
+    async def api(self, *shards, ctx=None, background: bool=False,
+                  max_age: float=None, prefetch: bool=False, **kwargs):
+        """Requests shards of the world, a nation, a region or a WA council
+
+        Pass the command's ctx, so that the request counts towards its
+        user's and server's quotas; CommandOnCooldown is raised once they
+        are used up. background requests, such as periodic or bulk
+        fetches, are not limited by quotas, but wait for commands and leave
+        background_reserve requests of the rate limit free.
+
+        If max_age is given, the last response to the same request is
+        returned instead if it was fetched at most max_age seconds ago.
+        Prefetched responses are returned this way to everyone for warm_ttl
+        seconds; prefetches are always background requests."""
+        await self._loading
         self.check_agent()
         args = {"shard": list(shards), "user_agent": self.settings["AGENT"],
                 "auto_load": True, "version": "9", "use_error_xrls": True,
                 "use_error_rl": True}
+        if not kwargs:
+            args["api"] = "world"
+        elif len(kwargs) != 1:
+            raise TypeError("Multiple **kwargs: {}".format(kwargs))
+        else:
+            nation = kwargs.pop("nation", None)
+            region = kwargs.pop("region", None)
+            council = kwargs.pop("council", None)
+            if kwargs:
+                raise TypeError("Unexpected **kwargs: {}".format(kwargs))
+            if nation:
+                args.update(api="nation", value=nation)
+            if region:
+                args.update(api="region", value=region)
+            if council:
+                args.update(api="wa", value=council)
+        if args["api"] in NAMED:
+            args["value"] = self.canonical(args["value"])
+            missing = self._missing.get((args["api"], args["value"]))
+            if missing is not None and time() < missing:
+                # Known not to exist; no need to ask again
+                raise await self._not_found(args["api"], args["value"])
+        key = (args["api"], str(args.get("value")),
+               tuple(sorted(map(str, shards))))
+        if not prefetch:
+            if time() < self._warm.get(key, 0):
+                max_age = max(max_age or 0, self.warm_ttl)
+            if max_age is not None and key in self._responses:
+                fetched, blob = self._responses[key]
+                if time() - fetched <= max_age:
+                    # Still asked for, so it is prefetched again
+                    self.bot.dispatch("ns_request", args["api"],
+                                      args.get("value"), shards)
+                    return pickle.loads(blob)
+        if self._api is None:
+            await self.bot.loop.run_in_executor(executor, self._client)
+        from nationstates.NScore.exceptions import NotFound, RateLimitCatch
+        background = background or prefetch
+        server = ctx and ctx.message.server and ctx.message.server.id
+        if not self._breaker_allows():
+            return await self._stale(key)
+        probe = self._probing
         try:
-            if not kwargs:
-                args["api"] = "world"
-            elif len(kwargs) != 1:
-                raise TypeError("Multiple **kwargs: {}".format(kwargs))
-            else:
-                nation = kwargs.pop("nation", None)
-                region = kwargs.pop("region", None)
-                council = kwargs.pop("council", None)
-                if kwargs:
-                    raise TypeError("Unexpected **kwargs: {}".format(kwargs))
-                if nation:
-                    args.update(api="nation", value=nation)
-                if region:
-                    args.update(api="region", value=region)
-                if council:
-                    args.update(api="wa", value=council)
-            part = partial(self._api.request, **args)
+            # Only charged for requests that are going to be sent
+            if ctx is not None and not background and \
+                    not checks.is_owner_check(ctx):
+                self._charge(server, ctx.message.author.id)
+            await self._turn(server, background)
+            self._usage.append((time(), server, ctx and ctx.message.author.id,
+                                background))
+            self._prune_usage()
+            self._sending += 1
             try:
-                ret = await wait_for(self.bot.loop.run_in_executor(
-                    executor, part), timeout=10)
-                return ret.collect()
-            except TimeoutError:
-                await self.bot.say("Error: Request timed out.")
-                raise
+                ret, data = await self._attempts(args, key)
+            finally:
+                self._sending -= 1
         except NotFound as e:
-            raise ValueError(*e.args) from e
+            if args["api"] not in NAMED:
+                raise ValueError(*e.args) from e
+            self._missing[(args["api"], args["value"])] = \
+                time() + self.missing_ttl
+            raise (await self._not_found(args["api"], args["value"])) from e
         except RateLimitCatch as e:
-            await self.bot.say(" ".join(e.args))
+            await self._say(" ".join(e.args))
             retry_after = 30. - (time() - min(self._api.get_ratelimit()))
             raise commands.CommandOnCooldown(30, retry_after)
+        finally:
+            if probe:
+                # However the probe ended, let another one through later
+                self._probing = False
+        if ret is None:
+            # Stale data from _stale
+            return data
+        self._remember(key, shards, data)
+        if prefetch:
+            now = time()
+            self._warm = {warm: expires for warm, expires
+                          in self._warm.items() if expires > now}
+            self._warm[key] = now + self.warm_ttl
+        else:
+            # on_ns_request(api, value, shards) lets cogs learn what is
+            # asked for, e.g. to prefetch it; prefetches aren't included,
+            # and cache hits are
+            self.bot.dispatch("ns_request", args["api"], args.get("value"),
+                              shards)
+        # Cogs may listen with on_ns_response(api, value, data) to
+        # reuse fetched data. Listeners run after the caller resumes
+        # and must treat data as read-only.
+        self.bot.dispatch("ns_response", args["api"],
+                          args.get("value"), data)
+        return data
+
+    async def on_ns_response(self, api, value, data):
+        # Learns names from responses; only reads keys that callers
+        # don't rewrite
+        names = {"nation": [], "region": []}
+        if api in NAMED:
+            names[api].append(data.get("id") or value)
+        if api == "nation" and isinstance(data.get("region"), str):
+            names["region"].append(data["region"])
+        for key, sep in (("nations", ":"), ("members", ","),
+                         ("delegates", ",")):
+            if isinstance(data.get(key), str):
+                names["nation"].extend(filter(None, data[key].split(sep)))
+        for kind, found in names.items():
+            if found:
+                await self.bot.loop.run_in_executor(
+                    None, self.learn, kind, found)
+
+    async def _not_found(self, kind, name):
+        if len(self._missing) > 4096:
+            now = time()
+            # learn removes entries from executor threads
+            with self._names_lock:
+                self._missing = {key: expires for key, expires
+                                 in self._missing.items() if expires > now}
+        return NameNotFound(kind, name, await self.bot.loop.run_in_executor(
+            None, self.suggest, kind, name))
+
+    async def _attempts(self, args, key):
+        # Returns the request and its data, or None and stale data
+        from xml.parsers.expat import ExpatError
+        from nationstates.NScore.exceptions import APIError, NotFound
+        from requests.exceptions import RequestException
+        attempt = 0
+        while True:
+            timings = []
+            start = perf_counter()
+            future = self.bot.loop.run_in_executor(
+                executor, self._request, args, timings)
+            try:
+                # Shielded, so a timeout leaves the future to tell when the
+                # executor is free again
+                ret, data = await wait_for(shield(future),
+                                           timeout=self._timeout())
+            except TimeoutError as e:
+                self._stuck = future
+                future.add_done_callback(_retrieve)
+                error = e
+            except NotFound:
+                self._succeeded(perf_counter() - start)
+                raise
+            except (RequestException, APIError, ExpatError) as e:
+                status = getattr(e, "status", None)
+                if isinstance(e, APIError) and (status is None or
+                                                status < 500):
+                    # NationStates answered, it just didn't like the
+                    # request, or the request was never sent
+                    self._succeeded()
+                    raise
+                error = e
+            else:
+                error = None
+            if error is not None:
+                self._failed()
+                attempt += 1
+                # A retry would only queue behind a request that timed out,
+                # and time out in turn
+                if attempt > self.retries or self._open_until is not None \
+                        or self.budget() < 10 or self._executor_stuck():
+                    return (None, await self._stale(key, error))
+                # Full jitter, so retries from many commands don't line up
+                await sleep(uniform(0, 0.5 * 2 ** attempt))
+                continue
+            self._succeeded(perf_counter() - start)
+            if self.phase_log is not None:
+                self._log_phases(args, start, timings, ret)
+            return ret, data
+
+    def _log_phases(self, args, submitted, timings, ret):
+        # queue: waiting for the executor; network: until the response
+        # headers arrived; parse: reading the body and parsing the XML
+        started, finished = timings
+        response = ret.data.get("request_instance")
+        network = min(finished - started, response.elapsed.total_seconds()
+                      if response is not None else 0.)
+        api, value = args["api"], args.get("value")
+        self.phase_log.extend((
+            (api, value, "queue", started - submitted),
+            (api, value, "network", network),
+            (api, value, "parse", finished - started - network)))
+
+    def log_format(self, api: str, value, seconds: float):
+        """Records time a cog spent formatting a response, while profiling
+
+        api and value are as passed to api, e.g. "nation" and the nation."""
+        if self.phase_log is not None:
+            self.phase_log.append((api, value, "format", seconds))
+
+    def budget(self) -> int:
+        """Returns how many more requests fit in the current rate limit
+
+        Keeps a margin under NationStates' 50 requests per 30 seconds.
+        Requests still being sent are counted as well."""
+        now = time()
+        while self._raw_sent and now - self._raw_sent[0] >= 30:
+            self._raw_sent.popleft()
+        used = self._sending + len(self._raw_sent)
+        if self._api is None:
+            return 45 - used
+        return 45 - used - sum(
+            1 for sent in self._api.get_ratelimit() if now - sent < 30)
+
+    def _charge(self, server, user):
+        # Takes a token from the user's and the server's buckets, or raises
+        # CommandOnCooldown if either is empty
+        now = time()
+        buckets = []
+        wait = 0.
+        for scope, id in (("USER", user), ("SERVER", server)):
+            if id is None:
+                continue
+            per_minute, burst = self.settings["QUOTAS"][scope]
+            bucket = self._buckets[scope].setdefault(id, [burst, now])
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) *
+                            per_minute / 60)
+            bucket[1] = now
+            if bucket[0] < 1:
+                wait = max(wait, (1 - bucket[0]) * 60 / per_minute)
+            buckets.append(bucket)
+        if wait:
+            self._throttled[user] += 1
+            raise commands.CommandOnCooldown(60, wait)
+        for bucket in buckets:
+            bucket[0] -= 1
+
+    async def _turn(self, server, background):
+        # Weighted fair queuing: requests only queue while the rate limit
+        # is short, then go in order of virtual finish time, commands first
+        reserve = self.background_reserve if background else 1
+        if self.budget() >= reserve and (
+                not self._queue or not background and self._queue[0][0]):
+            return
+        flow = "background" if background else server
+        weight = 1. if background else float(
+            self.settings["WEIGHTS"].get(server, 1))
+        finish = max(self._virtual, self._finish.get(flow, 0.)) + 1 / weight
+        self._finish[flow] = finish
+        future = self.bot.loop.create_future()
+        heapq.heappush(self._queue,
+                       (background, finish, next(self._order), future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = self.bot.loop.create_task(self._dispatch())
+        await future
+
+    async def _dispatch(self):
+        while self._queue:
+            background, finish, _, future = self._queue[0]
+            if self.budget() < (self.background_reserve if background else 1):
+                await sleep(self._refill())
+                continue
+            heapq.heappop(self._queue)
+            if future.done():
+                # The command was cancelled
+                continue
+            self._virtual = finish
+            future.set_result(None)
+            # Let it start sending before checking the budget again
+            await sleep(0)
+        # Idle; start fresh
+        self._finish.clear()
+        self._virtual = 0.
+
+    def _refill(self):
+        # Seconds until the oldest request leaves the rate limit window
+        if self._api is None:
+            return 0.5
+        now = time()
+        recent = [sent for sent in self._api.get_ratelimit()
+                  if now - sent < 30]
+        return max(0.1, 30 - (now - min(recent))) if recent else 0.5
+
+    def _prune_usage(self):
+        hour = time() - 3600
+        while self._usage and self._usage[0][0] < hour:
+            self._usage.popleft()
+
+    async def _set_quota(self, scope, per_minute, burst):
+        if per_minute < 1 or burst < 1:
+            return await self.bot.say("Both numbers must be at least 1.")
+        await self._loading
+        self.settings["QUOTAS"][scope] = [per_minute, burst]
+        dataIO.save_json("data/nsapi/settings.json", self.settings)
+        self._buckets[scope].clear()
+        await self.bot.say("Each {} may now make {} requests a minute, in "
+                           "bursts of up to {}.".format(
+                               scope.lower(), per_minute, burst))
+
+    def _server_name(self, id):
+        if id is None:
+            return "Direct messages"
+        server = self.bot.get_server(id)
+        return server.name if server else id
+
+    def _user_name(self, server, id):
+        server = server and self.bot.get_server(server)
+        member = server and server.get_member(id)
+        return member.name if member else id
+
+    def _timeout(self):
+        # Adapts to observed latency once there are enough samples
+        if len(self._latencies) < 20:
+            return 10.
+        latencies = sorted(self._latencies)
+        p95 = latencies[int(0.95 * (len(latencies) - 1))]
+        return max(self.min_timeout, min(self.max_timeout, 2 * p95))
+
+    def _breaker_allows(self):
+        if self._open_until is None:
+            return True
+        if time() < self._open_until or self._probing or \
+                self._executor_stuck():
+            return False
+        # Half-open: let a single probe request through
+        self._probing = True
+        return True
+
+    def _executor_stuck(self):
+        return self._stuck is not None and not self._stuck.done()
+
+    def _succeeded(self, latency=None):
+        if latency is not None:
+            self._latencies.append(latency)
+        self._failures = 0
+        self._open_until = None
+        self._probing = False
+
+    def _failed(self):
+        self._failures += 1
+        if self._probing or self._failures >= self.failure_threshold:
+            self._open_until = time() + self.open_time
+            self._probing = False
+
+    async def _stale(self, key, error=None):
+        # Fail fast, or serve the last response for the same request
+        try:
+            fetched, blob = self._responses[key]
+        except KeyError:
+            if error is None:
+                raise commands.CommandOnCooldown(
+                    self.open_time, max(1., self._open_until - time()))
+            if isinstance(error, TimeoutError):
+                await self._say("Error: Request timed out.")
+            raise error
+        await self._say("NationStates isn't responding. Showing data "
+                        "from {:.0f} minutes ago.".format(
+                            (time() - fetched) / 60))
+        return pickle.loads(blob)
+
+    def _remember(self, key, shards, data):
+        # Pickled, as callers are free to modify what they get back
+        if any((shard[0] if isinstance(shard, tuple) else shard).lower()
+               in TEXT_SHARDS for shard in shards):
+            # api_texts keeps these in the text store
+            return
+        blob = pickle.dumps(data, pickle.HIGHEST_PROTOCOL)
+        old = self._responses.pop(key, None)
+        if old is not None:
+            self._responses_size -= len(old[1])
+        if len(blob) > self.responses_bytes // 8:
+            return
+        self._responses[key] = (time(), blob)
+        self._responses_size += len(blob)
+        while self._responses_size > self.responses_bytes:
+            self._responses_size -= len(
+                self._responses.popitem(last=False)[1][1])
+
+    async def _say(self, content):
+        # Background tasks have no channel to reply to
+        try:
+            await self.bot.say(content)
+        except discord.InvalidArgument:
+            pass
+
+    async def _save_loop(self):
+        # Batches text store index saves, and writes them off the loop
+        try:
+            await self._loading
+            while True:
+                await sleep(60)
+                removed = self.texts.expire()
+                if not self.texts.dirty:
+                    continue
+                try:
+                    await self.bot.loop.run_in_executor(
+                        None, self.texts.save, self.texts.snapshot(), removed)
+                except CancelledError:
+                    raise
+                except Exception as e:
+                    self.texts.dirty = True
+                    print("NSApi: could not save the text store: {!r}".format(
+                        e))
+        except CancelledError:
+            pass
+
+    def _client(self):
+        # Runs in the executor
+        if self._api is not None:
+            return
+        start = perf_counter()
+        from nationstates import Api
+        self._api = Api()
+        # nationstates doesn't keep the status of responses it raises for
+        self._api.__session__.hooks["response"].append(self._record_status)
+        self.startup["client"] = perf_counter() - start
+
+    def _request(self, args, timings=None):
+        # Runs in the executor; returns the request and its data. Errors
+        # get the HTTP status of the response as status, or None if there
+        # was no response
+        if timings is not None:
+            timings.append(perf_counter())
+        from nationstates import Shard
+        from nationstates.NScore.exceptions import APIError
+        self._status = None
+        try:
+            ret = self._api.request(**dict(args, shard=[
+                Shard(shard[0], **dict(shard[1]))
+                if isinstance(shard, tuple) else shard
+                for shard in args["shard"]]))
+            # nationstates only raises for some 5xx responses, and parses
+            # others, or a truncated body, as empty
+            data = ret.collect()
+            if self._status >= 500:
+                raise APIError("NationStates returned HTTP {}".format(
+                    self._status))
+        except Exception as e:
+            e.status = self._status
+            raise
+        if timings is not None:
+            timings.append(perf_counter())
+        return ret, data
+
+    def _record_status(self, response, **kwargs):
+        # Runs in the executor, as a requests response hook
+        self._status = response.status_code
+
+    def _read_names(self):
+        try:
+            with open("data/nsapi/names.txt") as file:
+                self._names = file.read().splitlines()
+        except FileNotFoundError:
+            self._names = []
+        self._ids = {name: id for id, name in enumerate(self._names)}
+
+    def _read_known(self):
+        self._known = {kind: NameIndex("data/nsapi/{}s.ids".format(kind))
+                       for kind in NAMED}
+
+    def _load(self):
+        # Runs in the default executor, off the event loop
+        start = perf_counter()
+        check_folders()
+        check_files()
+        self.settings = dataIO.load_json("data/nsapi/settings.json")
+        self.texts = TextStore("data/nsapi/texts")
+        self.startup["data"] = perf_counter() - start
+
+
+def _stream(url, agent, path, compress):
+    # Runs in an executor; returns (status, Retry-After, bytes written)
+    import requests
+    response = requests.get(url, headers={"User-Agent": agent},
+                            stream=True, timeout=(10, 60))
+    try:
+        if response.status_code != 200:
+            return (response.status_code,
+                    response.headers.get("Retry-After"), 0)
+        if compress and response.headers.get("Content-Encoding") == "gzip":
+            chunks = response.raw.stream(CHUNK, decode_content=False)
+            opener = open
+        else:
+            chunks = response.iter_content(CHUNK)
+            opener = gzip.open if compress else open
+        try:
+            with opener(path, "wb") as file:
+                for chunk in chunks:
+                    file.write(chunk)
+        except BaseException:
+            if os.path.exists(path):
+                os.remove(path)
+            raise
+        return (200, None, os.path.getsize(path))
+    finally:
+        response.close()
+
+
+def _retrieve(future):
+    # Timed out requests' results and errors are of no further use
+    if not future.cancelled():
+        future.exception()
+
+
+def _trigrams(name):
+    name = "${}$".format(name)
+    return {name[i:i + 3] for i in range(len(name) - 2)}
 
 
 def check_folders():
-    fol = "data/nsapi"
-    if not os.path.exists(fol):
-        print("Creating {} folder...".format(fol))
-        os.makedirs(fol)
+    for fol in ("data/nsapi", "data/nsapi/texts"):
+        if not os.path.exists(fol):
+            print("Creating {} folder...".format(fol))
+            os.makedirs(fol)
 
 
 def check_files():
     fil = "data/nsapi/settings.json"
     if not dataIO.is_valid_json(fil):
         print("Creating default {}...".format(fil))
-        dataIO.save_json(fil, {"AGENT": None})
+        dataIO.save_json(fil, DEFAULTS)
+        return
+    settings = dataIO.load_json(fil)
+    if any(key not in settings for key in DEFAULTS):
+        dataIO.save_json(fil, dict(DEFAULTS, **settings))
+
+
+def timed_setup(bot, cog_class, import_time: float, *prepare):
+    """Adds a cog to the bot, recording how long loading it took
+
+    import_time is how long the cog's module took to import. The functions
+    in prepare, such as check_folders, are run first. Both times are kept in
+    the cog's startup dict, which [p]nsstartup lists."""
+    start = perf_counter()
+    for function in prepare:
+        function()
+    cog = cog_class(bot)
+    bot.add_cog(cog)
+    if not hasattr(cog, "startup"):
+        cog.startup = {}
+    cog.startup["import"] = import_time
+    cog.startup["setup"] = perf_counter() - start
+    return cog
 
 
 def setup(bot):
-    check_folders()
-    check_files()
-    bot.add_cog(NSApi(bot))
+    timed_setup(bot, NSApi, _IMPORT_TIME)
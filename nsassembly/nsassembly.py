@@ -1,3 +1,8 @@
+from time import perf_counter
+_IMPORT_START = perf_counter()
+
+import re
+from collections import OrderedDict
 from html import unescape
 from random import randint
 from datetime import datetime, timezone
@@ -6,12 +11,132 @@ import discord
 from discord.ext import commands
 from .utils.chat_formatting import pagify
 
+try:
+    from .nsapi import NSApi, timed_setup
+except ImportError:
+    # NSApi isn't installed; the cog still loads, and its commands say
+    # how to install it
+    NSApi = timed_setup = None
+
+_IMPORT_TIME = perf_counter() - _IMPORT_START
+
+
+# BBCode tags, HTML tags (from lastresolution and happenings), entities, and
+# the @@nation@@ and %%region%% markers of happenings text.
+# NS double-escapes entities in resolution text, hence the optional "amp;".
+TOKEN = re.compile(r"\[(/?)(\*|[a-z]+)(?:=([^\]]*))?\]"
+                   r"|<(/?)([a-z]+)\b([^>]*)>"
+                   r"|&(?:amp;)?(#?\w+);"
+                   r"|@@([\w-]+)@@|%%([\w-]+)%%", re.IGNORECASE)
+HREF = re.compile(r"""href\s*=\s*["']?([^"'\s>]+)""", re.IGNORECASE)
+MARKERS = {"b": "**", "strong": "**", "i": "*", "em": "*", "u": "__",
+           "s": "~~", "strike": "~~", "del": "~~", "spoiler": "||"}
+LINKS = {"url", "a", "nation", "region"}
+# Tags whose content is kept without any formatting
+PLAIN = {"color", "colour", "size", "font", "align", "center", "left",
+         "right", "sup", "sub", "pre", "code", "box", "anchor", "table",
+         "tr", "td", "th", "span", "p", "div", "small", "big"}
+TAGS = set(MARKERS) | LINKS | PLAIN | {"quote", "list"}
+
+
+def render(text: str, masked: bool=True) -> str:
+    """Renders NationStates BBCode and HTML as Discord markdown in one pass
+
+    Masked links only work in embeds; with masked=False, links are written
+    out as "label <url>" for plain messages instead."""
+    out = []
+    # [tag, index of its opening marker in out, parameter, list item count]
+    stack = []
+    pos = 0
+    for match in TOKEN.finditer(text):
+        out.append(text[pos:match.start()])
+        pos = match.end()
+        if match.group(7) is not None:
+            out.append(unescape("&{};".format(match.group(7))))
+            continue
+        if match.group(8) is not None or match.group(9) is not None:
+            tag = "nation" if match.group(8) is not None else "region"
+            _close(out, [tag, len(out), None, 0],
+                   masked, match.group(8) or match.group(9))
+            continue
+        if match.group(2) is not None:
+            closing, tag, param = match.group(1, 2, 3)
+        else:
+            closing, tag, attrs = match.group(4, 5, 6)
+            href = HREF.search(attrs)
+            param = href.group(1) if href else None
+        tag = tag.lower()
+        if tag in ("br", "hr"):
+            out.append("\n" if tag == "br" else "\n\n")
+        elif tag == "*":
+            for frame in reversed(stack):
+                if frame[0] == "list":
+                    frame[3] += 1
+                    out.append("\n{}. ".format(frame[3]) if frame[2]
+                               else "\n• ")
+                    break
+            else:
+                out.append(match.group(0))
+        elif tag not in TAGS:
+            out.append(match.group(0))
+        elif not closing:
+            stack.append([tag, len(out), param, 0])
+            out.append(MARKERS.get(tag, ""))
+        else:
+            for index in reversed(range(len(stack))):
+                if stack[index][0] == tag:
+                    # Implicitly close anything left open inside this tag
+                    while len(stack) > index:
+                        _close(out, stack.pop(), masked)
+                    break
+    out.append(text[pos:])
+    # Close anything never closed in the text
+    while stack:
+        _close(out, stack.pop(), masked)
+    return "".join(out)
+
+
+def _close(out, frame, masked, label=None):
+    tag, start, param, _ = frame
+    if tag in MARKERS:
+        out.append(MARKERS[tag])
+    elif tag in LINKS:
+        if label is None:
+            label = "".join(out[start + 1:]).strip()
+        del out[start:]
+        if tag in ("nation", "region"):
+            url = "https://www.nationstates.net/{}={}".format(
+                tag, NSApi.canonical(label))
+            label = label.replace("_", " ")
+        else:
+            url = param or label
+            # Happenings links are relative, like "nation=testlandia"
+            if not re.match(r"[a-z]+://", url, re.IGNORECASE):
+                url = "https://www.nationstates.net/" + url.lstrip("/")
+        if masked:
+            out.append("[{}]({})".format(label or url, url))
+        elif not label or label == url:
+            out.append(url)
+        else:
+            out.append("{} <{}>".format(label, url))
+    elif tag == "quote":
+        body = "".join(out[start + 1:]).strip("\n")
+        del out[start:]
+        author = param.split(";")[0] if param else None
+        out.append("\n{}{}\n".format(
+            "**{}** wrote:\n".format(author) if author else "",
+            "\n".join("> " + line for line in body.split("\n"))))
+    elif tag == "list":
+        out.append("\n")
+
 
 class NSAssembly:
 
     def __init__(self, bot):
         self.bot = bot
         self.nsapi = None
+        # Rendered resolution texts by digest, most recently used last
+        self.rendered = OrderedDict()
 
     @commands.group(pass_context=True)
     async def ga(self, ctx):  # API requests: 2; non-API requests: 2
@@ -73,19 +198,10 @@ class NSAssembly:
             "sc" if sc else "ga")
         data = await self.nsapi.api(
             "resolution", "delvotes" if delegate else "resolution",
-            "lastresolution", council="2" if sc else "1")
+            "lastresolution", council="2" if sc else "1", ctx=ctx)
         if data["resolution"] is None:
-            out = unescape(data["lastresolution"]).replace(
-                "<strong>", "**").replace("</strong>", "**")
-            try:
-                out = "{}[{}](https://www.nationstates.net{}){}".format(
-                    out[:out.index("<a")],
-                    out[out.index("\">") + 2:out.index("</a")],
-                    out[out.index("=\"") + 2:out.index("\">")],
-                    out[out.index("</a>") + 4:])
-            except ValueError:
-                pass
-            embed = discord.Embed(title="Last Resolution", description=out,
+            embed = discord.Embed(title="Last Resolution",
+                                  description=render(data["lastresolution"]),
                                   colour=randint(0, 0xFFFFFF))
             embed.set_thumbnail(
                 url="http://i.imgur.com/{}.jpg".format(
@@ -109,7 +225,7 @@ class NSAssembly:
             description="Category: {}".format(data["category"]),
             colour=randint(0, 0xFFFFFF))
         authdata = await self.nsapi.api(
-            "fullname", "flag", nation=data["proposed_by"])
+            "fullname", "flag", nation=data["proposed_by"], ctx=ctx)
         embed.set_author(name=authdata["fullname"],
                          url="https://www.nationstates.net/nation={}".format(
                              data["proposed_by"]), icon_url=authdata["flag"])
@@ -130,15 +246,16 @@ class NSAssembly:
                             inline=False)
         elif str(ctx.invoked_subcommand).lower() == "{} resolution".format(
                 "sc" if sc else "ga"):
-            desc = unescape(data["desc"]).replace("[i]", "*").replace(
-                "[/i]", "*").replace("[b]", "**").replace(
-                    "[/b]", "**").replace("[u]", "__").replace(
-                        "[/u]", "__").replace("&#39;", "'").replace(
-                            "&quot;", "\"")
-            if len(desc) > 1000:
-                message = pagify(desc)
-            else:
+            # The resolution shard always includes the text, so it can't be
+            # skipped, but only the stored copy is kept
+            key = "wa:{}:desc:{}".format(2 if sc else 1,
+                                         data.get("id") or data["promoted"])
+            desc = self._render(key, self.nsapi.texts.put(
+                key, data.pop("desc")))
+            if isinstance(desc, str):
                 embed.add_field(name="Resolution", value=desc, inline=False)
+            else:
+                message = desc
         percent = 100 * float(data["total_votes_for"]) / (
             float(data["total_votes_for"]) + float(data["total_votes_against"]))
         embed.add_field(name="Total Votes",
@@ -152,6 +269,24 @@ class NSAssembly:
                 "Voting began %a, %d %b %Y %H:%M:%S GMT"))
         return (message, embed)
 
+    def _render(self, key, digest):
+        # Long texts are rendered once per resolution, not once per command
+        try:
+            self.rendered.move_to_end(digest)
+            return self.rendered[digest]
+        except KeyError:
+            pass
+        text = self.nsapi.texts.get(key)
+        desc = render(text)
+        if len(desc) > 1000:
+            # Message pages can't use masked links
+            desc = tuple(pagify(render(text, masked=False),
+                                delims=["\n\n", "\n", " "], shorten_by=10))
+        self.rendered[digest] = desc
+        if len(self.rendered) > 8:
+            self.rendered.popitem(last=False)
+        return desc
+
     def _checks(self, prefix):
         if self.nsapi is None or self.nsapi != self.bot.get_cog('NSApi'):
             self.nsapi = self.bot.get_cog('NSApi')
@@ -164,4 +299,7 @@ class NSAssembly:
 
 
 def setup(bot):
-    bot.add_cog(NSAssembly(bot))
+    if timed_setup is None:
+        bot.add_cog(NSAssembly(bot))
+    else:
+        timed_setup(bot, NSAssembly, _IMPORT_TIME)
@@ -0,0 +1,545 @@
+from time import perf_counter
+_IMPORT_START = perf_counter()
+
+import gzip
+import os
+import shutil
+from asyncio import sleep, CancelledError
+from datetime import datetime
+from tempfile import mkdtemp
+from time import time
+from urllib.request import Request, urlopen
+from xml.etree.ElementTree import iterparse
+
+import numpy as np
+from discord.ext import commands
+
+from __main__ import send_cmd_help
+from cogs.utils import checks
+
+from .utils.dataIO import dataIO
+from .utils.chat_formatting import box
+
+try:
+    from .nsapi import timed_setup
+except ImportError:
+    # NSApi isn't installed; the cog still loads, and its commands say
+    # how to install it
+    timed_setup = None
+
+_IMPORT_TIME = perf_counter() - _IMPORT_START
+
+
+SPARKS = np.array(list("▁▂▃▄▅▆▇█"))
+DUMP_URL = "https://www.nationstates.net/pages/nations.xml.gz"
+
+
+class WorldCensus:
+    """Census scores of every nation, loaded from the daily nations dump
+
+    Rows are nations. scores, ranks and order have one column per scale;
+    ranks holds each row's 0-based world rank and order holds the rows
+    sorted by rank, so lookups are single index operations."""
+
+    def __init__(self, timestamp, scales, ids, regions, scores, ranks,
+                 order):
+        self.timestamp = timestamp
+        self.columns = {scale: i for i, scale in enumerate(scales)}
+        self.ids = ids
+        self.regions = regions
+        self.scores = scores
+        self.ranks = ranks
+        self.order = order
+        self.rows = np.full(int(ids.max()) + 1 if len(ids) else 0, -1,
+                            dtype=np.int32)
+        self.rows[ids] = np.arange(len(ids), dtype=np.int32)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def row(self, nation_id: int):
+        """Returns the row of an interned nation ID, or None"""
+        if nation_id >= len(self.rows) or self.rows[nation_id] < 0:
+            return None
+        return int(self.rows[nation_id])
+
+    def rank(self, row: int, scale: int):
+        """Returns a nation's (score, world rank, region rank, region size)
+
+        Ranks are 1-based."""
+        column = self.columns[scale]
+        rank = self.ranks[row, column]
+        region = self.regions == self.regions[row]
+        return (float(self.scores[row, column]), int(rank) + 1,
+                int(np.count_nonzero(
+                    self.ranks[region, column] < rank)) + 1,
+                int(np.count_nonzero(region)))
+
+    def top(self, scale: int, count: int, region_id: int=None):
+        """Returns the rows of the top nations, worldwide or in a region"""
+        column = self.columns[scale]
+        if region_id is None:
+            return self.order[:count, column]
+        rows = np.flatnonzero(self.regions == region_id)
+        return rows[np.argsort(self.ranks[rows, column])[:count]]
+
+    @classmethod
+    def build(cls, path, scales, learn):
+        """Parses a nations dump and saves the arrays next to it
+
+        learn is NSApi.learn, which interns every nation and region name.
+        Runs in an executor."""
+        columns = {scale: i for i, scale in enumerate(scales)}
+        names, regions, scores = [], [], []
+        with gzip.open(path) as file:
+            context = iterparse(file, events=("start", "end"))
+            _, root = next(context)
+            for event, elem in context:
+                if event != "end" or elem.tag != "NATION":
+                    continue
+                names.append(elem.findtext("NAME"))
+                regions.append(elem.findtext("REGION"))
+                row = [np.nan] * len(scales)
+                for scale in elem.iterfind("CENSUS/SCALE"):
+                    column = columns.get(int(scale.get("id")))
+                    if column is not None:
+                        row[column] = float(scale.findtext("SCORE"))
+                scores.append(row)
+                root.clear()
+        ids = np.array(learn("nation", names), dtype=np.uint32)
+        regions = np.array(learn("region", regions), dtype=np.uint32)
+        scores = np.array(scores, dtype=np.float32).reshape(-1, len(scales))
+        # NaN scores sort last
+        order = np.argsort(-scores, axis=0, kind="stable").astype(np.int32)
+        ranks = np.empty_like(order)
+        for column in range(len(scales)):
+            ranks[order[:, column], column] = np.arange(len(order),
+                                                        dtype=np.int32)
+        # A new folder each time: the last arrays may still be memory-mapped
+        # and in use, so their files must never be rewritten
+        folder = os.path.dirname(path)
+        timestamp = time()
+        arrays = os.path.basename(mkdtemp(prefix="arrays-", dir=folder))
+        for name, array in (("ids", ids), ("regions", regions),
+                            ("scores", scores), ("ranks", ranks),
+                            ("order", order)):
+            np.save(os.path.join(folder, arrays, name + ".npy"), array)
+        dataIO.save_json(os.path.join(folder, "meta.json"),
+                         {"TIME": timestamp, "SCALES": scales,
+                          "ARRAYS": arrays})
+        # Unlinking mapped files is fine on POSIX; elsewhere they go on a
+        # later build
+        for old in os.listdir(folder):
+            if old.startswith("arrays-") and old != arrays:
+                shutil.rmtree(os.path.join(folder, old), ignore_errors=True)
+            elif old.endswith(".npy"):
+                # Saved before arrays had their own folders
+                try:
+                    os.remove(os.path.join(folder, old))
+                except OSError:
+                    pass
+        return cls(timestamp, scales, ids, regions, scores, ranks, order)
+
+    @classmethod
+    def load(cls, folder):
+        """Memory-maps previously built arrays, or returns None"""
+        meta = os.path.join(folder, "meta.json")
+        if not dataIO.is_valid_json(meta):
+            return None
+        meta = dataIO.load_json(meta)
+        folder = os.path.join(folder, meta.get("ARRAYS", ""))
+        return cls(meta["TIME"], meta["SCALES"], *(
+            np.load(os.path.join(folder, name + ".npy"), mmap_mode="r")
+            for name in ("ids", "regions", "scores", "ranks", "order")))
+
+
+class NSCensus:
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.nsapi = None
+        self.settings = dataIO.load_json("data/nscensus/settings.json")
+        self.settings.setdefault("WORLD", False)
+        self.settings.setdefault("WORLD_SCALES", [65, 66])
+        self.world = WorldCensus.load("data/nscensus/world")
+        self.task = bot.loop.create_task(self._track_loop())
+        self.world_task = bot.loop.create_task(self._world_loop())
+
+    def __unload(self):
+        self.task.cancel()
+        self.world_task.cancel()
+
+    @commands.group(pass_context=True)
+    async def census(self, ctx):
+        """Census score history of tracked nations
+
+        Tracked nations have their census scores recorded on a schedule.
+        Queries are answered from those records without any API requests.
+        Quotes are needed if a nation name contains spaces."""
+        if ctx.invoked_subcommand is None:
+            await send_cmd_help(ctx)
+
+    @census.command(name="track", pass_context=True)
+    @checks.is_owner()
+    # API requests: 1; non-API requests: 0
+    async def _census_track(self, ctx, *, nation):
+        """Starts recording a nation's census scores"""
+        self._checks(ctx.prefix)
+        nation = self.nsapi.canonical(nation)
+        if nation in self.settings["NATIONS"]:
+            return await self.bot.say("That nation is already tracked.")
+        try:
+            await self._record(nation, ctx)
+        except ValueError:
+            return await self.bot.say("That nation does not exist.")
+        self.settings["NATIONS"].append(nation)
+        dataIO.save_json("data/nscensus/settings.json", self.settings)
+        await self.bot.say("Now tracking {}.".format(nation))
+
+    @census.command(name="untrack")
+    @checks.is_owner()
+    # API requests: 0; non-API requests: 0
+    async def _census_untrack(self, *, nation):
+        """Stops recording a nation's census scores
+
+        Its existing records are kept."""
+        self._checks("[p]")
+        nation = self.nsapi.canonical(nation)
+        try:
+            self.settings["NATIONS"].remove(nation)
+        except ValueError:
+            return await self.bot.say("That nation isn't tracked.")
+        dataIO.save_json("data/nscensus/settings.json", self.settings)
+        await self.bot.say("No longer tracking {}.".format(nation))
+
+    @census.command(name="scales")
+    @checks.is_owner()
+    # API requests: 0; non-API requests: 0
+    async def _census_scales(self, *scales: int):
+        """Gets or sets the census scale IDs that are recorded
+
+        e.g. 65 for Influence and 66 for WA Endorsements."""
+        if scales:
+            self.settings["SCALES"] = sorted(set(scales))
+            dataIO.save_json("data/nscensus/settings.json", self.settings)
+        await self.bot.say("Recording scales: {}".format(
+            ", ".join(map(str, self.settings["SCALES"]))))
+
+    @census.command(name="list")
+    # API requests: 0; non-API requests: 0
+    async def _census_list(self):
+        """Lists the tracked nations"""
+        if not self.settings["NATIONS"]:
+            return await self.bot.say("No nations are tracked.")
+        lines = []
+        for nation in self.settings["NATIONS"]:
+            times = self._column(nation, "time")
+            lines.append("{}: {} records{}".format(
+                nation, len(times), " since {}".format(
+                    datetime.utcfromtimestamp(times[0]).strftime(
+                        "%Y-%m-%d")) if len(times) else ""))
+        await self.bot.say(box("\n".join(lines)))
+
+    @census.command(name="trend")
+    # API requests: 0; non-API requests: 0
+    async def _census_trend(self, nation, scale: int=66, days: float=7.):
+        """Trend of a tracked nation's census score over X days"""
+        window = self._window(nation, scale, days)
+        if isinstance(window, str):
+            return await self.bot.say(window)
+        times, scores = window
+        days = (times - times[0]) / 86400
+        slope = np.polyfit(days, scores, 1)[0] if days[-1] > 0 else 0.
+        await self.bot.say(box(
+            "{}\n"
+            "Scale {}, {} records over {:.1f} days\n"
+            "First {:.2f} | Last {:.2f}\n"
+            "Min {:.2f} | Mean {:.2f} | Max {:.2f}\n"
+            "Trend {:+.2f}/day".format(
+                _sparkline(scores), scale, len(scores), days[-1],
+                scores[0], scores[-1], scores.min(), scores.mean(),
+                scores.max(), slope)))
+
+    @census.command(name="delta")
+    # API requests: 0; non-API requests: 0
+    async def _census_delta(self, nation, scale: int=66, days: float=7.):
+        """Change in a tracked nation's census score over X days"""
+        window = self._window(nation, scale, days)
+        if isinstance(window, str):
+            return await self.bot.say(window)
+        times, scores = window
+        await self.bot.say("{:+.2f} over {:.1f} days ({:.2f} to {:.2f})".format(
+            scores[-1] - scores[0], (times[-1] - times[0]) / 86400,
+            scores[0], scores[-1]))
+
+    @census.command(name="rate")
+    # API requests: 0; non-API requests: 0
+    async def _census_rate(self, nation, scale: int=66, days: float=7.):
+        """Daily rate of change of a tracked nation's census score
+
+        Shows the average rate over X days, and the fastest daily rise and
+        fall between consecutive records."""
+        window = self._window(nation, scale, days)
+        if isinstance(window, str):
+            return await self.bot.say(window)
+        times, scores = window
+        if len(times) < 2:
+            return await self.bot.say("Not enough records yet.")
+        rates = np.diff(scores) / (np.diff(times) / 86400)
+        await self.bot.say(box(
+            "Average {:+.2f}/day over {:.1f} days\n"
+            "Fastest rise {:+.2f}/day | Fastest fall {:+.2f}/day".format(
+                (scores[-1] - scores[0]) / ((times[-1] - times[0]) / 86400),
+                (times[-1] - times[0]) / 86400, rates.max(), rates.min())))
+
+    @census.command(name="world")
+    @checks.is_owner()
+    # API requests: 0; non-API requests: 0
+    async def _census_world(self, *scales: int):
+        """Toggles daily loading of world census scores
+
+        Any given scale IDs replace the scales that are loaded. World scores
+        come from the daily nations dump, which is downloaded once a day
+        instead of making any API requests."""
+        if scales:
+            self.settings["WORLD_SCALES"] = sorted(set(scales))
+            self.settings["WORLD"] = True
+        else:
+            self.settings["WORLD"] = not self.settings["WORLD"]
+        dataIO.save_json("data/nscensus/settings.json", self.settings)
+        if not self.settings["WORLD"]:
+            return await self.bot.say("World census scores disabled.")
+        await self.bot.say("World census scores enabled for scales {}. "
+                           "Loading the nations dump...".format(", ".join(
+                               map(str, self.settings["WORLD_SCALES"]))))
+        await self._refresh_world()
+        await self.bot.say("Loaded {} nations.".format(len(self.world)))
+
+    @census.command(name="rank")
+    # API requests: 0; non-API requests: 0
+    async def _census_rank(self, nation, scale: int=66):
+        """World and regional rank of a nation in a census scale
+
+        Ranks are as of the most recent daily nations dump."""
+        if self.world is None:
+            return await self.bot.say("World census scores are not loaded.")
+        if scale not in self.world.columns:
+            return await self.bot.say("That scale is not loaded.")
+        self._checks("[p]")
+        nation = self.nsapi.known_id(nation)
+        row = None if nation is None else self.world.row(nation)
+        if row is None:
+            return await self.bot.say("That nation is not in the dump.")
+        score, rank, rrank, rsize = self.world.rank(row, scale)
+        await self.bot.say(box(
+            "Scale {}: {:.2f}\n"
+            "World: #{} of {} ({:.2f} percentile)\n"
+            "{}: #{} of {} ({:.2f} percentile)".format(
+                scale, score, rank, len(self.world),
+                _percentile(rank, len(self.world)),
+                self.nsapi.id_name(int(self.world.regions[row])), rrank,
+                rsize, _percentile(rrank, rsize))))
+
+    @census.command(name="top")
+    # API requests: 0; non-API requests: 0
+    async def _census_top(self, scale: int=66, *, region=None):
+        """Top 10 nations in a census scale, worldwide or in a region
+
+        Ranks are as of the most recent daily nations dump."""
+        if self.world is None:
+            return await self.bot.say("World census scores are not loaded.")
+        if scale not in self.world.columns:
+            return await self.bot.say("That scale is not loaded.")
+        self._checks("[p]")
+        if region is not None:
+            region = self.nsapi.known_id(region)
+            if region is None:
+                return await self.bot.say("That region is not in the dump.")
+        rows = self.world.top(scale, 10, region)
+        if not len(rows):
+            return await self.bot.say("That region is not in the dump.")
+        column = self.world.columns[scale]
+        names = self.nsapi.id_names(self.world.ids[rows].tolist())
+        await self.bot.say(box("\n".join(
+            "#{:<7} {:<40} {:.2f}".format(
+                int(self.world.ranks[row, column]) + 1, name,
+                float(self.world.scores[row, column]))
+            for row, name in zip(rows.tolist(), names))))
+
+    def world_rank(self, nation: str, scale: int):
+        """Returns a nation's world rank info, or None if unavailable
+
+        See WorldCensus.rank."""
+        # Called by other cogs, possibly before any command set self.nsapi
+        nsapi = self.bot.get_cog("NSApi")
+        if self.world is None or scale not in self.world.columns or \
+                nsapi is None:
+            return None
+        nation = nsapi.known_id(nation)
+        row = None if nation is None else self.world.row(nation)
+        if row is None:
+            return None
+        return self.world.rank(row, scale)
+
+    def _window(self, nation, scale, days):
+        self._checks("[p]")
+        nation = self.nsapi.canonical(nation)
+        times = self._column(nation, "time")
+        if not len(times):
+            return "That nation has no records."
+        scores = self._column(nation, scale)
+        if not len(scores):
+            return "That scale has not been recorded for that nation."
+        # Both columns are append-only, so times is sorted
+        start = np.searchsorted(times, time() - 86400 * days)
+        times, scores = times[start:len(scores)], scores[start:]
+        recorded = ~np.isnan(scores)
+        times, scores = times[recorded], scores[recorded]
+        if not len(scores):
+            return "No records in that time span."
+        return times, scores.astype(np.float64)
+
+    def _column(self, nation, column):
+        path = _path(nation, column)
+        dtype = np.float64 if column == "time" else np.float32
+        try:
+            if os.path.getsize(path):
+                return np.memmap(path, dtype=dtype, mode="r")
+        except FileNotFoundError:
+            pass
+        return np.empty(0, dtype=dtype)
+
+    async def _track_loop(self):
+        try:
+            await self.bot.wait_until_ready()
+            while True:
+                for nation in list(self.settings["NATIONS"]):
+                    try:
+                        self._checks("[p]")
+                        await self._record(nation)
+                    except CancelledError:
+                        raise
+                    except Exception as e:
+                        print("NSCensus: could not record {}: {!r}".format(
+                            nation, e))
+                await sleep(self.settings["INTERVAL"])
+        except CancelledError:
+            pass
+
+    async def _world_loop(self):
+        try:
+            await self.bot.wait_until_ready()
+            while True:
+                if self.settings["WORLD"] and (
+                        self.world is None or
+                        time() - self.world.timestamp > 86400):
+                    try:
+                        self._checks("[p]")
+                        await self._refresh_world()
+                    except CancelledError:
+                        raise
+                    except Exception as e:
+                        print("NSCensus: could not load the nations dump: "
+                              "{!r}".format(e))
+                await sleep(3600)
+        except CancelledError:
+            pass
+
+    async def _refresh_world(self):
+        path = "data/nscensus/world/nations.xml.gz"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._checks("[p]")
+        await self.bot.loop.run_in_executor(None, _download, path,
+                                            self.nsapi.settings["AGENT"])
+        self.world = await self.bot.loop.run_in_executor(
+            None, WorldCensus.build, path, self.settings["WORLD_SCALES"],
+            self.nsapi.learn)
+
+    async def _record(self, nation, ctx=None):
+        # Periodic records are background requests
+        scales = self.settings["SCALES"]
+        data = await self.nsapi.api(self.nsapi.shard(
+            "census", scale="+".join(map(str, scales)), mode="score"),
+            nation=nation, ctx=ctx, background=ctx is None)
+        now = time()
+        records = data["census"]["scale"]
+        if isinstance(records, dict):
+            records = [records]
+        scores = {int(record["id"]): float(record["score"])
+                  for record in records}
+        os.makedirs("data/nscensus/{}".format(nation), exist_ok=True)
+        length = len(self._column(nation, "time"))
+        for scale in scales:
+            with open(_path(nation, scale), "ab") as file:
+                # Pad scales that were added after tracking began
+                missing = length - file.tell() // 4
+                column = np.full(missing + 1, np.nan, dtype=np.float32)
+                column[-1] = scores.get(scale, np.nan)
+                column.tofile(file)
+        with open(_path(nation, "time"), "ab") as file:
+            np.array([now], dtype=np.float64).tofile(file)
+
+    def _checks(self, prefix):
+        if self.nsapi is None or self.nsapi != self.bot.get_cog('NSApi'):
+            self.nsapi = self.bot.get_cog('NSApi')
+            if self.nsapi is None:
+                raise RuntimeError(
+                    "NSApi cog is not loaded. Please ensure it is:\n"
+                    "Installed: {p}cog install NationCogs nsapi\n"
+                    "Loaded: {p}load nsapi".format(p=prefix))
+        self.nsapi.check_agent()
+
+
+def _path(nation, column):
+    if column == "time":
+        return "data/nscensus/{}/time.f8".format(nation)
+    return "data/nscensus/{}/{}.f4".format(nation, column)
+
+
+def _download(path, agent):
+    # The timeout applies to each read, so a stalled download gives up
+    # instead of holding an executor thread
+    request = Request(DUMP_URL, headers={"User-Agent": agent})
+    with urlopen(request, timeout=60) as response, \
+            open(path + ".part", "wb") as file:
+        shutil.copyfileobj(response, file)
+    os.replace(path + ".part", path)
+
+
+def _percentile(rank, total):
+    return 100. * (total - rank) / max(total - 1, 1)
+
+
+def _sparkline(scores, width=30):
+    if len(scores) > width:
+        scores = np.interp(np.linspace(0, len(scores) - 1, width),
+                           np.arange(len(scores)), scores)
+    low, high = scores.min(), scores.max()
+    if high == low:
+        return "".join(SPARKS[np.zeros(len(scores), dtype=int)])
+    return "".join(SPARKS[((scores - low) / (high - low) * 7).round()
+                          .astype(int)])
+
+
+def check_folders():
+    fol = "data/nscensus"
+    if not os.path.exists(fol):
+        print("Creating {} folder...".format(fol))
+        os.makedirs(fol)
+
+
+def check_files():
+    fil = "data/nscensus/settings.json"
+    if not dataIO.is_valid_json(fil):
+        print("Creating default {}...".format(fil))
+        dataIO.save_json(fil, {"NATIONS": [], "SCALES": [65, 66],
+                               "INTERVAL": 43200})
+
+
+def setup(bot):
+    if timed_setup is None:
+        check_folders()
+        check_files()
+        bot.add_cog(NSCensus(bot))
+    else:
+        timed_setup(bot, NSCensus, _IMPORT_TIME, check_folders, check_files)
@@ -1,8 +1,15 @@
+from time import perf_counter
+_IMPORT_START = perf_counter()
+
+import csv
+import gzip
+import json
 import os
+from collections import deque
 
 import aiofiles
 import discord
-from asyncio import Lock
+from asyncio import Lock, gather, sleep
 from discord.ext import commands
 
 from __main__ import send_cmd_help
@@ -11,6 +18,15 @@ from cogs.utils import checks
 from .utils.dataIO import dataIO
 from .utils.chat_formatting import box, pagify
 
+try:
+    from .nsapi import timed_setup
+except ImportError:
+    # NSApi isn't installed; the cog still loads, and its commands say
+    # how to install it
+    timed_setup = None
+
+_IMPORT_TIME = perf_counter() - _IMPORT_START
+
 
 class EndoError(Exception):
     pass
@@ -22,7 +38,9 @@ class NSEndorse:
         self.bot = bot
         self.nsapi = None
         self.delim = ', '
-        self.locks = {"ne": Lock(), "nne": Lock()}
+        self.locks = {"ne": Lock(), "nne": Lock(), "export": Lock()}
+        # Requests kept in flight
+        self.window = 4
 
     @commands.command(pass_context=True)
     # API requests: 1; non-API requests: 0
@@ -31,7 +49,7 @@ class NSEndorse:
         self._checks(ctx.prefix)
         await self._file(ctx.message.channel,
                          self._endocheck(await self.nsapi.api(
-                             "endorsements", "wa", nation=wanation))
+                             "endorsements", "wa", nation=wanation, ctx=ctx))
                          ["endorsements"].replace(",", self.delim), "ne")
 
     @commands.command(pass_context=True)
@@ -40,7 +58,8 @@ class NSEndorse:
         """Number of Nations Endorsing (Count) the specified WA nation"""
         self._checks(ctx.prefix)
         await self.bot.say(self._endocheck(await self.nsapi.api(
-            "censusscore-66", "wa", nation=wanation))["censusscore"]["text"])
+            "censusscore-66", "wa", nation=wanation,
+            ctx=ctx))["censusscore"]["text"])
 
     @commands.command(pass_context=True)
     # API requests: 3; non-API requests: 0
@@ -49,8 +68,8 @@ class NSEndorse:
         self._checks(ctx.prefix)
         endos = self._endocheck(
             await self.nsapi.api("endorsements", "region", "wa",
-                                 nation=wanation))
-        nne = (await self._region_wa(endos["region"])).difference(
+                                 nation=wanation, ctx=ctx))
+        nne = (await self._region_wa(endos["region"], ctx)).difference(
             "{},{}".format(endos["endorsements"], endos["id"]).split(","))
         await self._file(ctx.message.channel, self.delim.join(nne), "nne")
 
@@ -61,8 +80,8 @@ class NSEndorse:
         self._checks(ctx.prefix)
         endos = self._endocheck(
             await self.nsapi.api("censusscore-66", "region", "wa",
-                                 nation=wanation))
-        nne = len(await self._region_wa(endos["region"])) - \
+                                 nation=wanation, ctx=ctx))
+        nne = len(await self._region_wa(endos["region"], ctx)) - \
             float(endos["censusscore"]["text"]) - 1
         await self.bot.say("{}.00".format(int(nne)))
 
@@ -72,7 +91,83 @@ class NSEndorse:
         """The Soft Power Distribution Rating of the specified nation"""
         self._checks(ctx.prefix)
         await self.bot.say((await self.nsapi.api(
-            "censusscore-65", nation=nation))["censusscore"]["text"])
+            "censusscore-65", nation=nation, ctx=ctx))["censusscore"]["text"])
+
+    @commands.command(pass_context=True, no_pm=True)
+    @checks.mod_or_permissions(manage_server=True)
+    # API requests: 2 + 1 per nation; non-API requests: 0
+    async def export(self, ctx, region, fmt="csv"):
+        """Exports every nation in a region with WA and endorsement data
+
+        fmt is csv or jsonl; the file is sent gzip-compressed. Nations are
+        fetched in the background without starving other commands, so large
+        regions take a while. Quotes are needed if the region name contains
+        spaces."""
+        fmt = fmt.lower()
+        if fmt not in ("csv", "jsonl"):
+            raise commands.BadArgument("Format must be csv or jsonl.")
+        self._checks(ctx.prefix)
+        region = self.nsapi.canonical(region)
+        if self.locks["export"].locked():
+            return await self.bot.say("An export is already running.")
+        async with self.locks["export"]:
+            try:
+                nations, wamembers = await self._region_members(region, ctx)
+            except ValueError:
+                return await self.bot.say("That region does not exist.")
+            message = await self.bot.say("Exporting {} nations...".format(
+                len(nations)))
+            path = "data/nsendorse/{}.{}.gz".format(region, fmt)
+            try:
+                with gzip.open(path, "wt", newline="") as file:
+                    write = _writer(fmt, file)
+                    count = 0
+                    for nation, task in self._export_fetches(nations, ctx):
+                        write(_export_row(nation, nation in wamembers,
+                                          await task))
+                        count += 1
+                        if not count % 50:
+                            await self.bot.edit_message(
+                                message, "Exporting {} nations... {}/{}"
+                                .format(len(nations), count, len(nations)))
+                await self.bot.edit_message(message, "Exported {} nations."
+                                            .format(count))
+                await self.bot.send_file(ctx.message.channel, path)
+            finally:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def _export_fetches(self, nations, ctx):
+        # Yields (nation, task) in region order while keeping a small window
+        # of requests in flight, so only that window is ever held in memory
+        window = deque()
+        try:
+            for nation in nations:
+                window.append((nation, self.bot.loop.create_task(
+                    self._export_fetch(nation, ctx))))
+                if len(window) >= self.window:
+                    yield window.popleft()
+            while window:
+                yield window.popleft()
+        finally:
+            for _, task in window:
+                task.cancel()
+            # Retrieves their exceptions, so none go unreported
+            gather(*(task for _, task in window), return_exceptions=True)
+
+    async def _export_fetch(self, nation, ctx):
+        while True:
+            try:
+                # Background requests leave NSApi's reserve to commands
+                return await self.nsapi.api(
+                    "wa", "endorsements", "influence", self.nsapi.shard(
+                        "census", scale="65+66", mode="score"),
+                    nation=nation, ctx=ctx, background=True)
+            except ValueError:
+                # Ceased to exist since the region was fetched
+                return None
+            except commands.CommandOnCooldown as e:
+                await sleep(e.retry_after)
 
     async def _file(self, channel: discord.Channel, text: str, method: str):
         if len(text) < 1024:
@@ -87,11 +182,15 @@ class NSEndorse:
                 await self.bot.send_file(
                     channel, "data/nsendorse/{}.txt".format(method))
 
-    async def _region_wa(self, region):
-        rnations = await self.nsapi.api("nations", region=region)
+    async def _region_wa(self, region, ctx=None):
+        nations, wamembers = await self._region_members(region, ctx)
+        return wamembers.intersection(nations)
+
+    async def _region_members(self, region, ctx=None):
+        rnations = await self.nsapi.api("nations", region=region, ctx=ctx)
         wamembers = set((await self.nsapi.api(
-            "members", council="1"))["members"].split(","))
-        return wamembers.intersection(rnations["nations"].split(":"))
+            "members", council="1", ctx=ctx))["members"].split(","))
+        return rnations["nations"].split(":"), wamembers
 
     def _endocheck(self, data):
         if data["unstatus"] == "Non-member":
@@ -110,6 +209,30 @@ class NSEndorse:
         self.nsapi.check_agent()
 
 
+def _export_row(nation, wa, data):
+    row = {"nation": nation, "wa": wa, "status": None, "endorsements": None,
+           "endorsed_by": None, "influence": None, "influence_score": None}
+    if data is None:
+        return row
+    scores = {scale["id"]: scale["score"] for scale in data["census"]["scale"]}
+    endorsements = data["endorsements"] or ""
+    row.update(status=data["unstatus"], endorsements=int(float(scores["66"])),
+               endorsed_by=endorsements.replace(",", " "),
+               influence=data["influence"],
+               influence_score=float(scores["65"]))
+    return row
+
+
+def _writer(fmt, file):
+    if fmt == "jsonl":
+        return lambda row: file.write(json.dumps(row) + "\n")
+    writer = csv.DictWriter(file, ("nation", "wa", "status", "endorsements",
+                                   "endorsed_by", "influence",
+                                   "influence_score"))
+    writer.writeheader()
+    return writer.writerow
+
+
 def check_folders():
     fol = "data/nsendorse"
     if not os.path.exists(fol):
@@ -118,5 +241,8 @@ def check_folders():
 
 
 def setup(bot):
-    check_folders()
-    bot.add_cog(NSEndorse(bot))
+    if timed_setup is None:
+        check_folders()
+        bot.add_cog(NSEndorse(bot))
+    else:
+        timed_setup(bot, NSEndorse, _IMPORT_TIME, check_folders)
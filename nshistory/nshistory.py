@@ -0,0 +1,401 @@
+from time import perf_counter
+_IMPORT_START = perf_counter()
+
+import os
+import struct
+from array import array
+from asyncio import sleep, CancelledError
+from bisect import bisect_right
+from datetime import datetime
+from io import BytesIO
+from time import time
+
+from discord.ext import commands
+
+from __main__ import send_cmd_help
+from cogs.utils import checks
+
+from .utils.dataIO import dataIO
+from .utils.chat_formatting import box
+
+try:
+    from .nsapi import timed_setup
+except ImportError:
+    # NSApi isn't installed; the cog still loads, and its commands say
+    # how to install it
+    timed_setup = None
+
+_IMPORT_TIME = perf_counter() - _IMPORT_START
+
+
+# timestamp, number of nations added, number of nations removed
+RECORD = struct.Struct("<dII")
+
+
+class Timeline:
+    """Membership history of a single region
+
+    The oldest retained snapshot is kept whole; every later snapshot is only
+    the sorted IDs that arrived and departed since the one before it, so
+    memory grows with churn rather than with region size times snapshots."""
+
+    __slots__ = ("base_time", "base", "times", "added", "removed", "current")
+
+    def __init__(self):
+        self.base_time = None
+        self.base = array("I")
+        self.times = array("d")
+        self.added = []
+        self.removed = []
+        self.current = array("I")
+
+    def record(self, timestamp: float, members):
+        """Diffs a full membership list against the latest snapshot
+
+        Returns the (added, removed) delta, or None if nothing changed."""
+        members = array("I", sorted(set(members)))
+        if self.base_time is None:
+            self.base_time = timestamp
+            self.base = members
+            self.current = members
+            return members, array("I")
+        old, new = set(self.current), set(members)
+        added = array("I", sorted(new.difference(old)))
+        removed = array("I", sorted(old.difference(new)))
+        if not added and not removed:
+            return None
+        self.times.append(timestamp)
+        self.added.append(added)
+        self.removed.append(removed)
+        self.current = members
+        return added, removed
+
+    def members(self, timestamp: float):
+        """Returns the set of member IDs as of the given time"""
+        if self.base_time is None or timestamp < self.base_time:
+            return set()
+        index = bisect_right(self.times, timestamp)
+        if index < len(self.times) / 2:
+            members = set(self.base)
+            for i in range(index):
+                members.difference_update(self.removed[i])
+                members.update(self.added[i])
+        else:
+            members = set(self.current)
+            for i in reversed(range(index, len(self.times))):
+                members.difference_update(self.added[i])
+                members.update(self.removed[i])
+        return members
+
+    def diff(self, start: float, end: float):
+        """Returns the net (joined, left) ID sets between two times"""
+        joined, left = set(), set()
+        for i in range(bisect_right(self.times, start),
+                       bisect_right(self.times, end)):
+            for nation in self.added[i]:
+                if nation in left:
+                    left.discard(nation)
+                else:
+                    joined.add(nation)
+            for nation in self.removed[i]:
+                if nation in joined:
+                    joined.discard(nation)
+                else:
+                    left.add(nation)
+        return joined, left
+
+    def churn(self, start: float, end: float):
+        """Returns the gross (arrivals, departures) counts between two times"""
+        first = bisect_right(self.times, start)
+        last = bisect_right(self.times, end)
+        return (sum(len(self.added[i]) for i in range(first, last)),
+                sum(len(self.removed[i]) for i in range(first, last)))
+
+    def compact(self, before: float):
+        """Folds all snapshots older than the given time into the base
+
+        Returns True if anything was folded."""
+        index = bisect_right(self.times, before)
+        if not index:
+            return False
+        members = set(self.base)
+        for i in range(index):
+            members.difference_update(self.removed[i])
+            members.update(self.added[i])
+        self.base = array("I", sorted(members))
+        self.base_time = self.times[index - 1]
+        del self.times[:index]
+        del self.added[:index]
+        del self.removed[:index]
+        return True
+
+    def dump(self, file):
+        file.write(_pack(self.base_time, self.base, array("I")))
+        for i, timestamp in enumerate(self.times):
+            file.write(_pack(timestamp, self.added[i], self.removed[i]))
+
+    @classmethod
+    def load(cls, file):
+        self = cls()
+        data = file.read()
+        offset = 0
+        while offset < len(data):
+            timestamp, nadded, nremoved = RECORD.unpack_from(data, offset)
+            offset += RECORD.size
+            added = array("I", data[offset:offset + 4 * nadded])
+            offset += 4 * nadded
+            removed = array("I", data[offset:offset + 4 * nremoved])
+            offset += 4 * nremoved
+            if self.base_time is None:
+                self.base_time = timestamp
+                self.base = added
+                self.current = added
+                continue
+            self.times.append(timestamp)
+            self.added.append(added)
+            self.removed.append(removed)
+            members = set(self.current)
+            members.difference_update(removed)
+            members.update(added)
+            self.current = array("I", sorted(members))
+        return self
+
+
+def _pack(timestamp, added, removed):
+    return b"".join((RECORD.pack(timestamp, len(added), len(removed)),
+                     added.tobytes(), removed.tobytes()))
+
+
+class NSHistory:
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.nsapi = None
+        self.settings = dataIO.load_json("data/nshistory/settings.json")
+        self.timelines = {}
+        self.task = bot.loop.create_task(self._snapshot_loop())
+
+    def __unload(self):
+        self.task.cancel()
+
+    @commands.group(pass_context=True)
+    async def history(self, ctx):
+        """Region membership history for watched regions"""
+        if ctx.invoked_subcommand is None:
+            await send_cmd_help(ctx)
+
+    @history.command(name="watch", pass_context=True)
+    @checks.is_owner()
+    # API requests: 1; non-API requests: 0
+    async def _history_watch(self, ctx, *, region):
+        """Starts taking periodic membership snapshots of a region"""
+        self._checks(ctx.prefix)
+        region = self.nsapi.canonical(region)
+        if region in self.settings["REGIONS"]:
+            return await self.bot.say("That region is already watched.")
+        try:
+            count = await self._snapshot(region, ctx)
+        except ValueError:
+            return await self.bot.say("That region does not exist.")
+        self.settings["REGIONS"].append(region)
+        dataIO.save_json("data/nshistory/settings.json", self.settings)
+        await self.bot.say("Now watching {} ({} nations).".format(
+            region, count))
+
+    @history.command(name="unwatch")
+    @checks.is_owner()
+    # API requests: 0; non-API requests: 0
+    async def _history_unwatch(self, *, region):
+        """Stops taking snapshots of a region
+
+        Its existing history is kept."""
+        self._checks("[p]")
+        region = self.nsapi.canonical(region)
+        try:
+            self.settings["REGIONS"].remove(region)
+        except ValueError:
+            return await self.bot.say("That region isn't watched.")
+        dataIO.save_json("data/nshistory/settings.json", self.settings)
+        await self.bot.say("No longer watching {}.".format(region))
+
+    @history.command(name="interval")
+    @checks.is_owner()
+    # API requests: 0; non-API requests: 0
+    async def _history_interval(self, minutes: int=None):
+        """Gets or sets the minutes between snapshots"""
+        if minutes is not None:
+            if minutes < 5:
+                return await self.bot.say("The interval must be at least "
+                                          "5 minutes.")
+            self.settings["INTERVAL"] = 60 * minutes
+            dataIO.save_json("data/nshistory/settings.json", self.settings)
+        await self.bot.say("Snapshots are taken every {} minutes.".format(
+            self.settings["INTERVAL"] // 60))
+
+    @history.command(name="list")
+    # API requests: 0; non-API requests: 0
+    async def _history_list(self):
+        """Lists the watched regions"""
+        if not self.settings["REGIONS"]:
+            return await self.bot.say("No regions are watched.")
+        lines = []
+        for region in self.settings["REGIONS"]:
+            timeline = self._timeline(region)
+            lines.append("{}: {} nations, {} snapshots since {}".format(
+                region, len(timeline.current), len(timeline.times) + 1,
+                datetime.utcfromtimestamp(timeline.base_time).strftime(
+                    "%Y-%m-%d %H:%M") if timeline.base_time else "never"))
+        await self.bot.say(box("\n".join(lines)))
+
+    @history.command(name="diff", pass_context=True)
+    # API requests: 0; non-API requests: 0
+    async def _history_diff(self, ctx, region, hours: float=24.):
+        """Nations that joined or left a watched region in the last X hours
+
+        Quotes are needed if the region name contains spaces."""
+        timeline = self._watched(region)
+        if timeline is None:
+            return await self.bot.say("That region isn't watched.")
+        now = time()
+        joined, left = timeline.diff(now - 3600 * hours, now)
+        await self._send(ctx.message.channel, "diff", (
+            "Joined ({}): {}".format(len(joined), ", ".join(
+                sorted(self.nsapi.id_names(joined)))),
+            "Left ({}): {}".format(len(left), ", ".join(
+                sorted(self.nsapi.id_names(left))))))
+
+    @history.command(name="members", pass_context=True)
+    # API requests: 0; non-API requests: 0
+    async def _history_members(self, ctx, region, hours: float=0.):
+        """Nations that were in a watched region X hours ago
+
+        Quotes are needed if the region name contains spaces."""
+        timeline = self._watched(region)
+        if timeline is None:
+            return await self.bot.say("That region isn't watched.")
+        members = timeline.members(time() - 3600 * hours)
+        await self._send(ctx.message.channel, "members", (
+            "Members ({}): {}".format(len(members), ", ".join(
+                sorted(self.nsapi.id_names(members)))),))
+
+    @history.command(name="rate")
+    # API requests: 0; non-API requests: 0
+    async def _history_rate(self, region, days: float=7.):
+        """Arrival and departure rates of a watched region over X days
+
+        Quotes are needed if the region name contains spaces."""
+        timeline = self._watched(region)
+        if timeline is None:
+            return await self.bot.say("That region isn't watched.")
+        if timeline.base_time is None:
+            return await self.bot.say("No snapshots have been taken yet.")
+        now = time()
+        start = max(now - 86400 * days, timeline.base_time)
+        span = max(now - start, 1.) / 86400
+        arrivals, departures = timeline.churn(start, now)
+        joined, left = timeline.diff(start, now)
+        await self.bot.say(box(
+            "Over {:.1f} days:\n"
+            "Arrivals: {} ({:.1f}/day)\n"
+            "Departures: {} ({:.1f}/day)\n"
+            "Net change: {:+d}".format(
+                span, arrivals, arrivals / span, departures,
+                departures / span, len(joined) - len(left))))
+
+    async def _send(self, channel, method, lines):
+        text = "\n\n".join(lines)
+        if len(text) < 1990:
+            await self.bot.send_message(channel, text)
+        else:
+            await self.bot.send_file(channel, BytesIO(text.encode()),
+                                     filename="{}.txt".format(method))
+
+    async def _snapshot_loop(self):
+        try:
+            await self.bot.wait_until_ready()
+            while True:
+                for region in list(self.settings["REGIONS"]):
+                    try:
+                        self._checks("[p]")
+                        await self._snapshot(region)
+                    except CancelledError:
+                        raise
+                    except Exception as e:
+                        print("NSHistory: could not snapshot {}: {!r}".format(
+                            region, e))
+                await sleep(self.settings["INTERVAL"])
+        except CancelledError:
+            pass
+
+    async def _snapshot(self, region, ctx=None):
+        # Periodic snapshots are background requests
+        data = await self.nsapi.api("nations", region=region, ctx=ctx,
+                                    background=ctx is None)
+        now = time()
+        ids = self.nsapi.intern_ids(
+            data["nations"].split(":") if data["nations"] else ())
+        timeline = self._timeline(region)
+        delta = timeline.record(now, ids)
+        path = "data/nshistory/{}.bin".format(region)
+        if timeline.compact(now - 86400 * self.settings["RETENTION"]):
+            with open(path, "wb") as file:
+                timeline.dump(file)
+        elif delta is not None:
+            with open(path, "ab") as file:
+                file.write(_pack(now, *delta))
+        return len(ids)
+
+    def _watched(self, region):
+        self._checks("[p]")
+        region = self.nsapi.canonical(region)
+        if region not in self.settings["REGIONS"] and \
+                region not in self.timelines:
+            return None
+        return self._timeline(region)
+
+    def _timeline(self, region):
+        try:
+            return self.timelines[region]
+        except KeyError:
+            pass
+        try:
+            with open("data/nshistory/{}.bin".format(region), "rb") as file:
+                timeline = Timeline.load(file)
+        except FileNotFoundError:
+            timeline = Timeline()
+        self.timelines[region] = timeline
+        return timeline
+
+    def _checks(self, prefix):
+        if self.nsapi is None or self.nsapi != self.bot.get_cog('NSApi'):
+            self.nsapi = self.bot.get_cog('NSApi')
+            if self.nsapi is None:
+                raise RuntimeError(
+                    "NSApi cog is not loaded. Please ensure it is:\n"
+                    "Installed: {p}cog install NationCogs nsapi\n"
+                    "Loaded: {p}load nsapi".format(p=prefix))
+        self.nsapi.check_agent()
+
+
+def check_folders():
+    fol = "data/nshistory"
+    if not os.path.exists(fol):
+        print("Creating {} folder...".format(fol))
+        os.makedirs(fol)
+
+
+def check_files():
+    fil = "data/nshistory/settings.json"
+    if not dataIO.is_valid_json(fil):
+        print("Creating default {}...".format(fil))
+        dataIO.save_json(fil, {"REGIONS": [], "INTERVAL": 3600,
+                               "RETENTION": 30})
+
+
+def setup(bot):
+    if timed_setup is None:
+        check_folders()
+        check_files()
+        bot.add_cog(NSHistory(bot))
+    else:
+        timed_setup(bot, NSHistory, _IMPORT_TIME, check_folders, check_files)
@@ -0,0 +1,296 @@
+from time import perf_counter
+_IMPORT_START = perf_counter()
+
+import os
+from asyncio import sleep, CancelledError
+from collections import OrderedDict
+from datetime import datetime
+from math import ceil
+from time import time
+
+from discord.ext import commands
+
+from __main__ import send_cmd_help
+from cogs.utils import checks
+
+from .utils.dataIO import dataIO
+from .utils.chat_formatting import box
+
+try:
+    from .nsapi import timed_setup
+except ImportError:
+    # NSApi isn't installed; the cog still loads, and its commands say
+    # how to install it
+    timed_setup = None
+
+_IMPORT_TIME = perf_counter() - _IMPORT_START
+
+
+class NSPrefetch:
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.nsapi = None
+        self.settings = dataIO.load_json("data/nsprefetch/settings.json")
+        # (api, value) -> [region, {shards: last requested}] for nations and
+        # regions requested by commands, most recently requested last
+        self.targets = OrderedDict()
+        for api, value, region, shards in dataIO.load_json(
+                "data/nsprefetch/targets.json"):
+            self.targets[(api, value)] = [region, {
+                _shards(signature): used for signature, used in shards}]
+        self.limit = 500
+        # Requests not made by a command for this long aren't prefetched
+        self.max_idle = 3 * 86400
+        self.per_update = 40
+        # Minutes to wait for a region to update after its predicted time
+        self.polls = 20
+        # Predicted update times already handled, by region
+        self.checked = {}
+        self._dirty = False
+        self.task = bot.loop.create_task(self._prefetch_loop())
+
+    def __unload(self):
+        self.task.cancel()
+        self._save()
+
+    @commands.group(pass_context=True)
+    async def prefetch(self, ctx):
+        """Prefetches what is asked about watched regions after they update"""
+        if ctx.invoked_subcommand is None:
+            await send_cmd_help(ctx)
+
+    @prefetch.command(name="watch", pass_context=True)
+    @checks.is_owner()
+    # API requests: 1; non-API requests: 0
+    async def _prefetch_watch(self, ctx, *, region):
+        """Starts prefetching a region's data after each of its updates
+
+        Nations in the region and the region itself are prefetched with the
+        same shards that commands recently asked for."""
+        self._checks(ctx.prefix)
+        region = self.nsapi.canonical(region)
+        if region in self.settings["REGIONS"]:
+            return await self.bot.say("That region is already watched.")
+        try:
+            data = await self.nsapi.api("lastupdate", region=region,
+                                        ctx=ctx)
+        except ValueError:
+            return await self.bot.say("That region does not exist.")
+        self.settings["REGIONS"].append(region)
+        self._updated(region, int(data["lastupdate"]))
+        await self.bot.say("Now watching {}.".format(region))
+
+    @prefetch.command(name="unwatch", pass_context=True)
+    @checks.is_owner()
+    # API requests: 0; non-API requests: 0
+    async def _prefetch_unwatch(self, ctx, *, region):
+        """Stops prefetching a region's data"""
+        self._checks(ctx.prefix)
+        region = self.nsapi.canonical(region)
+        try:
+            self.settings["REGIONS"].remove(region)
+        except ValueError:
+            return await self.bot.say("That region isn't watched.")
+        self.settings["UPDATES"].pop(region, None)
+        dataIO.save_json("data/nsprefetch/settings.json", self.settings)
+        await self.bot.say("No longer watching {}.".format(region))
+
+    @prefetch.command(name="list")
+    # API requests: 0; non-API requests: 0
+    async def _prefetch_list(self):
+        """Lists the watched regions and their predicted next updates"""
+        if not self.settings["REGIONS"]:
+            return await self.bot.say("No regions are watched.")
+        lines = []
+        for region in self.settings["REGIONS"]:
+            updates = self.settings["UPDATES"].get(region)
+            predicted = self._predict(region)
+            lines.append("{}: updated {}, next ~{}, {} requests".format(
+                region, _format(updates[-1] if updates else None),
+                _format(predicted), len(self._jobs(region))))
+        await self.bot.say(box("\n".join(lines)))
+
+    async def on_ns_request(self, api, value, shards):
+        if api not in ("nation", "region"):
+            return
+        target = self.targets.pop((api, value), None) or [
+            value if api == "region" else None, {}]
+        target[1][tuple(shards)] = time()
+        self.targets[(api, value)] = target
+        if len(self.targets) > self.limit:
+            self.targets.popitem(last=False)
+        self._dirty = True
+
+    async def on_ns_response(self, api, value, data):
+        if api == "region" and value in self.settings["REGIONS"] and \
+                data.get("lastupdate"):
+            self._updated(value, int(data["lastupdate"]))
+        elif api == "nation" and isinstance(data.get("region"), str):
+            target = self.targets.get((api, value))
+            if target is not None:
+                target[0] = self.bot.get_cog("NSApi").canonical(
+                    data["region"])
+
+    def _updated(self, region, timestamp):
+        updates = self.settings["UPDATES"].setdefault(region, [])
+        if timestamp in updates:
+            return
+        updates.append(timestamp)
+        updates.sort()
+        del updates[:-8]
+        dataIO.save_json("data/nsprefetch/settings.json", self.settings)
+
+    def _predict(self, region):
+        # Regions update at about the same time of day in each of the
+        # major and minor updates
+        updates = self.settings["UPDATES"].get(region)
+        if not updates:
+            return None
+        # Strictly after the last prediction handled, which would otherwise
+        # be predicted again, and not so long ago it can't be polled for
+        after = max(updates[-1] + 3600, self.checked.get(region, 0) + 1,
+                    time() - 60 * self.polls)
+        recent = [t for t in updates if t > updates[-1] - 2 * 86400]
+        # Until both updates have been seen, assume the other one is about
+        # 12 hours away
+        both = any(abs((updates[-1] - t) % 86400 - 43200) < 4 * 3600
+                   for t in recent)
+        return min(t + step * max(1, ceil((after - t) / step))
+                   for t in recent for step in (
+                       (86400,) if both else (86400, 43200)))
+
+    def _jobs(self, region):
+        # (last requested, api, value, shards), most recent first
+        now = time()
+        jobs = []
+        for (api, value), (target_region, shards) in self.targets.items():
+            if target_region != region:
+                continue
+            for signature, used in shards.items():
+                if now - used < self.max_idle:
+                    jobs.append((used, api, value, signature))
+        jobs.sort(key=lambda job: job[0], reverse=True)
+        return jobs[:self.per_update]
+
+    async def _prefetch_loop(self):
+        try:
+            await self.bot.wait_until_ready()
+            while True:
+                if self._dirty:
+                    self._save()
+                due = min(((predicted, region) for region, predicted in (
+                    (region, self._predict(region))
+                    for region in self.settings["REGIONS"])
+                    if predicted is not None), default=(None, None))
+                now = time()
+                if due[0] is None or \
+                        due[0] + self.settings["DELAY"] > now:
+                    await sleep(300 if due[0] is None else min(
+                        300, due[0] + self.settings["DELAY"] - now))
+                    continue
+                predicted, region = due
+                self.checked[region] = predicted
+                if predicted + 60 * self.polls < now:
+                    # Missed while the bot was down
+                    await sleep(1)
+                    continue
+                try:
+                    self._checks("[p]")
+                    await self._cycle(region)
+                except CancelledError:
+                    raise
+                except Exception as e:
+                    print("NSPrefetch: could not prefetch {}: {!r}".format(
+                        region, e))
+        except CancelledError:
+            pass
+
+    async def _cycle(self, region):
+        last = self.settings["UPDATES"][region][-1]
+        polls = self.polls
+        while True:
+            try:
+                # Not recorded as a command request
+                data = await self.nsapi.api("lastupdate", region=region,
+                                            prefetch=True)
+            except commands.CommandOnCooldown as e:
+                await sleep(e.retry_after)
+                continue
+            if int(data["lastupdate"]) > last:
+                break
+            polls -= 1
+            if not polls:
+                return
+            await sleep(60)
+        for _, api, value, shards in self._jobs(region):
+            # Prefetches are background requests, so they wait for commands
+            # and leave NSApi's reserve free
+            try:
+                await self.nsapi.api(*shards, prefetch=True, **{api: value})
+            except ValueError:
+                # Ceased to exist
+                continue
+            except commands.CommandOnCooldown as e:
+                await sleep(e.retry_after)
+
+    def _save(self):
+        self._dirty = False
+        now = time()
+        targets = []
+        for (api, value), (region, shards) in self.targets.items():
+            shards = [[signature, used] for signature, used in shards.items()
+                      if now - used < self.max_idle]
+            if shards:
+                targets.append([api, value, region, shards])
+        dataIO.save_json("data/nsprefetch/targets.json", targets)
+
+    def _checks(self, prefix):
+        if self.nsapi is None or self.nsapi != self.bot.get_cog('NSApi'):
+            self.nsapi = self.bot.get_cog('NSApi')
+            if self.nsapi is None:
+                raise RuntimeError(
+                    "NSApi cog is not loaded. Please ensure it is:\n"
+                    "Installed: {p}cog install NationCogs nsapi\n"
+                    "Loaded: {p}load nsapi".format(p=prefix))
+        self.nsapi.check_agent()
+
+
+def _shards(signature):
+    # JSON turns shard tuples into lists; shards must be hashable again
+    return tuple(shard if isinstance(shard, str) else
+                 (shard[0], tuple(map(tuple, shard[1])))
+                 for shard in signature)
+
+
+def _format(timestamp):
+    if timestamp is None:
+        return "unknown"
+    return datetime.utcfromtimestamp(timestamp).strftime("%H:%M UTC")
+
+
+def check_folders():
+    fol = "data/nsprefetch"
+    if not os.path.exists(fol):
+        print("Creating {} folder...".format(fol))
+        os.makedirs(fol)
+
+
+def check_files():
+    fil = "data/nsprefetch/settings.json"
+    if not dataIO.is_valid_json(fil):
+        print("Creating default {}...".format(fil))
+        dataIO.save_json(fil, {"REGIONS": [], "UPDATES": {}, "DELAY": 60})
+    fil = "data/nsprefetch/targets.json"
+    if not dataIO.is_valid_json(fil):
+        print("Creating default {}...".format(fil))
+        dataIO.save_json(fil, [])
+
+
+def setup(bot):
+    if timed_setup is None:
+        check_folders()
+        check_files()
+        bot.add_cog(NSPrefetch(bot))
+    else:
+        timed_setup(bot, NSPrefetch, _IMPORT_TIME, check_folders, check_files)
@@ -0,0 +1,299 @@
+from time import perf_counter
+_IMPORT_START = perf_counter()
+
+import dis
+import os
+import sys
+import threading
+import tracemalloc
+from asyncio import sleep
+from collections import Counter, defaultdict
+from datetime import datetime
+
+import discord
+from discord.ext import commands
+
+from cogs.utils import checks
+
+try:
+    from .nsapi import timed_setup
+except ImportError:
+    # NSApi isn't installed; the cog still loads, and its commands say
+    # how to install it
+    timed_setup = None
+
+_IMPORT_TIME = perf_counter() - _IMPORT_START
+
+
+class Sampler(threading.Thread):
+    """Low-overhead sampling profiler for every thread of the bot
+
+    Every interval seconds, the stacks of all other threads are recorded as
+    folded stacks ("thread;outer;...;inner"), the format read by
+    flamegraph.pl and speedscope."""
+
+    def __init__(self, interval: float):
+        super().__init__(name="NSProfile sampler", daemon=True)
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._done = threading.Event()
+
+    def run(self):
+        names = {}
+        while not self._done.wait(self.interval):
+            for thread in threading.enumerate():
+                names[thread.ident] = thread.name
+            for ident, frame in sys._current_frames().items():
+                if ident == self.ident:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append("{}:{}".format(
+                        os.path.basename(frame.f_code.co_filename),
+                        frame.f_code.co_name))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+    def stop(self):
+        self._done.set()
+        self.join()
+
+    def folded(self) -> str:
+        return "".join("{} {}\n".format(stack, count)
+                       for stack, count in sorted(self.stacks.items()))
+
+
+class NSProfile:
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.interval = 0.005
+        self.frames = 32
+        self.running = False
+        # Command start times by message ID, and the wall times of
+        # completed commands by qualified name
+        self.started = {}
+        self.commands = defaultdict(list)
+
+    @commands.command(pass_context=True)
+    @checks.is_owner()
+    # API requests: 0; non-API requests: 0
+    async def nsprofile(self, ctx, seconds: int=30):
+        """Profiles the bot for some seconds while it handles commands
+
+        Reports the wall time of every command run meanwhile, the time
+        NSApi requests spent queued, on the network and parsing, and the
+        time cogs spent formatting their responses, where the event loop and
+        executor threads spent their time, and the memory allocated and
+        still held by each command and line. A folded stack file is
+        attached; open it with speedscope or flamegraph.pl."""
+        if self.running:
+            return await self.bot.say("Already profiling.")
+        if not 1 <= seconds <= 300:
+            return await self.bot.say("Profile for 1 to 300 seconds.")
+        nsapi = self.bot.get_cog("NSApi")
+        self.running = True
+        self.started.clear()
+        self.commands.clear()
+        tracing = tracemalloc.is_tracing()
+        try:
+            if not tracing:
+                # Deep enough to reach the command from where it allocates
+                tracemalloc.start(self.frames)
+            before = tracemalloc.take_snapshot()
+            phases = []
+            if nsapi is not None:
+                nsapi.phase_log = phases
+            sampler = Sampler(self.interval)
+            message = await self.bot.say(
+                "Profiling for {} seconds...".format(seconds))
+            start = perf_counter()
+            sampler.start()
+            try:
+                await sleep(seconds)
+            finally:
+                sampler.stop()
+                elapsed = perf_counter() - start
+                if nsapi is not None and nsapi.phase_log is phases:
+                    nsapi.phase_log = None
+            after = await self.bot.loop.run_in_executor(
+                None, tracemalloc.take_snapshot)
+        finally:
+            if not tracing:
+                tracemalloc.stop()
+            self.running = False
+        report = await self.bot.loop.run_in_executor(
+            None, self._report, elapsed, sampler, phases, before, after,
+            _command_lines(self.bot))
+        stamp = datetime.utcnow().strftime("%Y%m%d-%H%M%S")
+        paths = []
+        for suffix, text in ((".txt", report), (".folded", sampler.folded())):
+            paths.append("data/nsprofile/{}{}".format(stamp, suffix))
+            with open(paths[-1], "w") as file:
+                file.write(text)
+        await self.bot.edit_message(message, "Profiled for {:.1f} seconds: "
+                                    "{} samples.".format(elapsed,
+                                                         sampler.samples))
+        try:
+            for path in paths:
+                await self.bot.send_file(ctx.message.channel, path)
+        except discord.HTTPException:
+            await self.bot.say("I need the `Attach files` permission to send "
+                               "the report. It was saved to data/nsprofile.")
+        else:
+            for path in paths:
+                os.remove(path)
+
+    async def on_command(self, command, ctx):
+        if self.running:
+            self.started[ctx.message.id] = perf_counter()
+
+    async def on_command_completion(self, command, ctx):
+        start = self.started.pop(ctx.message.id, None)
+        if start is not None:
+            self.commands[command.qualified_name].append(
+                perf_counter() - start)
+
+    async def on_command_error(self, error, ctx):
+        if ctx.command is not None:
+            await self.on_command_completion(ctx.command, ctx)
+
+    def _report(self, elapsed, sampler, phases, before, after, lines_of):
+        # Runs in the executor
+        lines = ["Profiled {:.1f}s, {} samples every {:.0f}ms".format(
+            elapsed, sampler.samples, 1e3 * self.interval), ""]
+        lines.append("Commands (wall time, including awaits)")
+        lines.extend(_table(
+            ("command", "runs", "total", "mean", "max"),
+            [(name, len(times), _ms(sum(times)), _ms(sum(times) / len(times)),
+              _ms(max(times))) for name, times in sorted(
+                 self.commands.items(), key=lambda item: -sum(item[1]))]))
+        lines.append("")
+        lines.append("NSApi requests (queue: waiting for the executor; "
+                     "network: until response headers; parse: body and XML; "
+                     "format: building the reply)")
+        per_api = defaultdict(Counter)
+        for api, _, phase, seconds in phases:
+            per_api[api][phase] += seconds
+            if phase == "queue":
+                per_api[api]["requests"] += 1
+        lines.extend(_table(
+            ("api", "requests", "queue", "network", "parse", "format"),
+            [(api, totals["requests"], _ms(totals["queue"]),
+              _ms(totals["network"]), _ms(totals["parse"]),
+              _ms(totals["format"]))
+             for api, totals in sorted(per_api.items())]))
+        lines.append("")
+        # Samples that were running a cog's own code, as opposed to waiting,
+        # are where formatting and other local work goes
+        lines.append("Busy samples by cog function (inclusive)")
+        inclusive, own = Counter(), Counter()
+        for stack, count in sampler.stacks.items():
+            frames = stack.split(";")
+            if _idle(frames[-1]):
+                continue
+            own[frames[-1]] += count
+            for frame in set(frames):
+                if frame.startswith("ns"):
+                    inclusive[frame] += count
+        lines.extend(_table(("function", "samples", "share"), [
+            (frame, count, "{:.1%}".format(count / max(1, sampler.samples)))
+            for frame, count in inclusive.most_common(15)]))
+        lines.append("")
+        lines.append("Busy samples by innermost function")
+        lines.extend(_table(("function", "samples", "share"), [
+            (frame, count, "{:.1%}".format(count / max(1, sampler.samples)))
+            for frame, count in own.most_common(15)]))
+        ignore = (tracemalloc.Filter(False, tracemalloc.__file__),
+                  tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                  tracemalloc.Filter(False, "<unknown>"))
+        after = after.filter_traces(ignore)
+        before = before.filter_traces(ignore)
+        lines.append("")
+        lines.append("Memory allocated and still held, by command")
+        per_command = defaultdict(lambda: [0, 0])
+        for stat in after.compare_to(before, "traceback"):
+            command = _command_of(stat.traceback, lines_of)
+            per_command[command][0] += stat.size_diff
+            per_command[command][1] += stat.count_diff
+        lines.extend(_table(("command", "size", "blocks"), [
+            (command or "(no command)",
+             "{:+.1f}KiB".format(size / 1024), "{:+d}".format(blocks))
+            for command, (size, blocks) in sorted(
+                per_command.items(), key=lambda item: -abs(item[1][0]))
+            if size]))
+        lines.append("")
+        lines.append("Memory allocated and still held, by line")
+        stats = after.compare_to(before, "lineno")
+        lines.extend(_table(("line", "size", "blocks"), [
+            ("{}:{}".format(os.path.basename(stat.traceback[0].filename),
+                            stat.traceback[0].lineno),
+             "{:+.1f}KiB".format(stat.size_diff / 1024),
+             "{:+d}".format(stat.count_diff))
+            for stat in stats[:15] if stat.size_diff]))
+        return "\n".join(lines) + "\n"
+
+
+def _command_lines(bot):
+    # {filename: [(first line, last line, qualified name)]} of every
+    # command's callback, to tell which command a traceback went through
+    lines_of = defaultdict(list)
+    todo = list(set(bot.commands.values()))
+    while todo:
+        command = todo.pop()
+        if isinstance(command, commands.GroupMixin):
+            todo.extend(set(command.commands.values()))
+        code = command.callback.__code__
+        lines_of[code.co_filename].append((
+            code.co_firstlineno,
+            max(line for _, line in dis.findlinestarts(code)),
+            command.qualified_name))
+    return lines_of
+
+
+def _command_of(traceback, lines_of):
+    # The command a traceback went through, if any
+    for frame in traceback:
+        for first, last, name in lines_of.get(frame.filename, ()):
+            if first <= frame.lineno <= last:
+                return name
+    return None
+
+
+def _idle(frame):
+    # Threads blocked waiting for work or I/O
+    return frame.rpartition(":")[2] in (
+        "select", "poll", "epoll", "wait", "acquire", "_worker", "get",
+        "recv_into", "read", "readinto", "sleep")
+
+
+def _ms(seconds):
+    return "{:.1f}ms".format(1e3 * seconds)
+
+
+def _table(header, rows):
+    if not rows:
+        return ["(none)"]
+    rows = [header] + [tuple(map(str, row)) for row in rows]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    return ["  ".join(cell.ljust(width) if i == 0 else cell.rjust(width)
+                      for i, (cell, width) in enumerate(zip(row, widths)))
+            for row in rows]
+
+
+def check_folders():
+    fol = "data/nsprofile"
+    if not os.path.exists(fol):
+        print("Creating {} folder...".format(fol))
+        os.makedirs(fol)
+
+
+def setup(bot):
+    if timed_setup is None:
+        check_folders()
+        bot.add_cog(NSProfile(bot))
+    else:
+        timed_setup(bot, NSProfile, _IMPORT_TIME, check_folders)
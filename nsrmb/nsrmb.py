@@ -0,0 +1,246 @@
+from time import perf_counter
+_IMPORT_START = perf_counter()
+
+import json
+import os
+from array import array
+from asyncio import sleep
+from datetime import datetime
+
+from discord.ext import commands
+
+from __main__ import send_cmd_help
+from cogs.utils import checks
+
+from .utils.chat_formatting import box
+
+try:
+    from .nsapi import timed_setup
+except ImportError:
+    # NSApi isn't installed; the cog still loads, and its commands say
+    # how to install it
+    timed_setup = None
+
+_IMPORT_TIME = perf_counter() - _IMPORT_START
+
+
+class Store:
+    """Append-only RMB message store for a single region
+
+    Each post is one "id<TAB>json" line on disk; only the post IDs and their
+    file offsets are kept in memory, so reading any page is one seek."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.ids = array("Q")
+        self.offsets = array("Q")
+        try:
+            with open(path, "rb") as file:
+                offset = 0
+                for line in file:
+                    self.ids.append(int(line[:line.index(b"\t")]))
+                    self.offsets.append(offset)
+                    offset += len(line)
+        except FileNotFoundError:
+            pass
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def cursor(self):
+        """The ID to fetch new posts from"""
+        return self.ids[-1] + 1 if self.ids else 0
+
+    def extend(self, posts):
+        """Appends posts newer than the last stored one
+
+        Returns how many were added."""
+        lines = []
+        for post in posts:
+            id = int(post["id"])
+            if self.ids and id <= self.ids[-1]:
+                continue
+            lines.append((id, "{}\t{}\n".format(id, json.dumps(
+                [int(post.get("timestamp") or 0), post.get("nation"),
+                 int(post.get("status") or 0), post.get("message") or ""],
+                separators=(",", ":"))).encode()))
+        if not lines:
+            return 0
+        with open(self.path, "ab") as file:
+            offset = file.tell()
+            for id, line in lines:
+                file.write(line)
+                self.ids.append(id)
+                self.offsets.append(offset)
+                offset += len(line)
+        return len(lines)
+
+    def read(self, start: int, count: int):
+        """Returns (id, timestamp, nation, status, message) tuples"""
+        posts = []
+        if start >= len(self.offsets):
+            return posts
+        with open(self.path, "rb") as file:
+            file.seek(self.offsets[start])
+            for _ in range(min(count, len(self.offsets) - start)):
+                id, _, post = file.readline().partition(b"\t")
+                posts.append((int(id), *json.loads(post.decode())))
+        return posts
+
+
+class NSRmb:
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.nsapi = None
+        self.stores = {}
+        self.page = 100
+        self.per_page = 10
+        # Pages of new posts fetched before reading an RMB
+        self.read_pages = 3
+
+    @commands.group(pass_context=True)
+    async def rmb(self, ctx):
+        """Locally stored Regional Message Board history"""
+        if ctx.invoked_subcommand is None:
+            await send_cmd_help(ctx)
+
+    @rmb.command(name="sync", pass_context=True)
+    @checks.is_owner()
+    # API requests: 1 per 100 new posts; non-API requests: 0
+    async def _rmb_sync(self, ctx, *, region):
+        """Downloads every RMB post of a region not yet stored
+
+        The first sync of a large region can take a while; later syncs only
+        fetch posts made since."""
+        self._checks(ctx.prefix)
+        region = self.nsapi.canonical(region)
+        store = await self._store(region)
+        message = await self.bot.say("Syncing {} from post {}...".format(
+            region, store.cursor))
+        try:
+            added, _ = await self._sync(region, ctx, message)
+        except ValueError:
+            return await self.bot.edit_message(
+                message, "That region does not exist.")
+        await self.bot.edit_message(
+            message, "Synced {}: {} new posts, {} stored.".format(
+                region, added, len(store)))
+
+    @rmb.command(name="read", pass_context=True)
+    # API requests: 1 to 3 if the region is synced; non-API requests: 0
+    async def _rmb_read(self, ctx, region, page: int=1):
+        """Reads a page of a synced region's RMB, newest first
+
+        New posts are fetched before reading. Quotes are needed if the region
+        name contains spaces."""
+        self._checks(ctx.prefix)
+        region = self.nsapi.canonical(region)
+        if not os.path.exists(_path(region)):
+            return await self.bot.say(
+                "That region's RMB hasn't been synced. An owner can sync it "
+                "with `{}rmb sync`.".format(ctx.prefix))
+        # Later pages are read as last synced
+        caught_up = True
+        if page == 1:
+            _, caught_up = await self._sync(region, ctx, pages=self.read_pages)
+        store = await self._store(region)
+        pages = max(1, -(-len(store) // self.per_page))
+        if not 1 <= page <= pages:
+            return await self.bot.say("Pages go from 1 to {}.".format(pages))
+        end = len(store) - (page - 1) * self.per_page
+        start = max(0, end - self.per_page)
+        lines = []
+        for id, timestamp, nation, status, text in store.read(
+                start, end - start):
+            if status in (1, 2, 9):
+                text = "(suppressed)" if status != 2 else "(deleted)"
+            text = " ".join(text.split())
+            lines.append("#{} {} {}:\n{}".format(
+                id, datetime.utcfromtimestamp(timestamp).strftime(
+                    "%Y-%m-%d %H:%M"), nation,
+                text if len(text) <= 160 else text[:159] + "…"))
+        await self.bot.say("{} page {}/{}{}{}".format(
+            region, page, pages, "" if caught_up else
+            " (more new posts than I could fetch at once; newer posts are "
+            "missing until the region is synced)",
+            box("\n\n".join(reversed(lines)))))
+
+    async def _sync(self, region, ctx, message=None, pages=None):
+        # Returns how many posts were added, and whether every new post was
+        # fetched
+        store = await self._store(region)
+        added = 0
+        while True:
+            try:
+                # Full syncs are background requests
+                data = await self.nsapi.api(self.nsapi.shard(
+                    "messages", limit=str(self.page),
+                    fromid=str(store.cursor)), region=region, ctx=ctx,
+                    background=pages is None)
+            except commands.CommandOnCooldown as e:
+                if pages is not None:
+                    # Out of quota, or NationStates is down; let the user
+                    # know instead of waiting on it
+                    raise
+                await sleep(e.retry_after)
+                continue
+            posts = data["messages"]["post"] if data["messages"] else []
+            if isinstance(posts, dict):
+                posts = [posts]
+            added += store.extend(posts)
+            if len(posts) < self.page:
+                break
+            if pages is not None:
+                pages -= 1
+                if not pages:
+                    return added, False
+            if message is not None:
+                await self.bot.edit_message(message, "Syncing {}: {} posts "
+                                            "stored...".format(
+                                                region, len(store)))
+            # Leave most of the rate limit to other commands
+            await sleep(1.5)
+        return added, True
+
+    async def _store(self, region):
+        # Opening a store reads the whole file, so it's done in the executor
+        store = self.stores.get(region)
+        if store is None:
+            store = self.stores[region] = self.bot.loop.run_in_executor(
+                None, Store, _path(region))
+        try:
+            return await store
+        except Exception:
+            self.stores.pop(region, None)
+            raise
+
+    def _checks(self, prefix):
+        if self.nsapi is None or self.nsapi != self.bot.get_cog('NSApi'):
+            self.nsapi = self.bot.get_cog('NSApi')
+            if self.nsapi is None:
+                raise RuntimeError(
+                    "NSApi cog is not loaded. Please ensure it is:\n"
+                    "Installed: {p}cog install NationCogs nsapi\n"
+                    "Loaded: {p}load nsapi".format(p=prefix))
+        self.nsapi.check_agent()
+
+
+def _path(region):
+    return "data/nsrmb/{}.rmb".format(region)
+
+
+def check_folders():
+    fol = "data/nsrmb"
+    if not os.path.exists(fol):
+        print("Creating {} folder...".format(fol))
+        os.makedirs(fol)
+
+
+def setup(bot):
+    if timed_setup is None:
+        check_folders()
+        bot.add_cog(NSRmb(bot))
+    else:
+        timed_setup(bot, NSRmb, _IMPORT_TIME, check_folders)
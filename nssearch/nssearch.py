@@ -0,0 +1,344 @@
+from time import perf_counter
+_IMPORT_START = perf_counter()
+
+import os
+import re
+import zlib
+from array import array
+from asyncio import sleep, CancelledError
+from bisect import bisect_left
+from collections import deque
+from datetime import datetime, timezone
+from html import unescape
+
+from discord.ext import commands
+
+from __main__ import send_cmd_help
+from cogs.utils import checks
+
+from .utils.dataIO import dataIO
+from .utils.chat_formatting import box
+
+try:
+    from .nsapi import NSApi, timed_setup
+except ImportError:
+    # NSApi isn't installed; the cog still loads, and its commands say
+    # how to install it
+    NSApi = timed_setup = None
+
+_IMPORT_TIME = perf_counter() - _IMPORT_START
+
+
+WORD = re.compile(r"[a-z0-9]+(?:[_'\-][a-z0-9]+)*")
+NATION = re.compile(r"@@(.+?)@@")
+REGION = re.compile(r"%%(.+?)%%")
+TAG = re.compile(r"<[^>]*>|\[[^\]]*\]")
+
+
+class Index:
+    """Bounded inverted index over happenings and RMB posts
+
+    Documents get ascending IDs, so every posting list is an ascending array
+    of IDs and evicting the oldest documents only ever trims the front of
+    posting lists. Nations and regions are indexed as "@name" and "%name"
+    tokens alongside the words of the text."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.first = 0
+        # (kind, source ID, timestamp, ...)
+        self.docs = deque()
+        self.seen = set()
+        self.postings = {}
+        self._evicted = 0
+
+    def __len__(self):
+        return len(self.docs)
+
+    def add(self, doc: tuple, tokens):
+        """Indexes a document, unless it is already indexed
+
+        Returns True if it was added."""
+        if doc[:2] in self.seen:
+            return False
+        id = self.first + len(self.docs)
+        self.docs.append(doc)
+        self.seen.add(doc[:2])
+        for token in tokens:
+            try:
+                self.postings[token].append(id)
+            except KeyError:
+                self.postings[token] = array("I", (id,))
+        while len(self.docs) > self.limit:
+            self.seen.discard(self.docs.popleft()[:2])
+            self.first += 1
+            self._evicted += 1
+        if self._evicted > self.limit // 4:
+            self._prune()
+        return True
+
+    def search(self, tokens, kind: str=None, start: int=None,
+               end: int=None):
+        """Returns the documents matching all tokens, newest first"""
+        if tokens:
+            lists = []
+            for token in tokens:
+                postings = self.postings.get(token)
+                if not postings:
+                    return []
+                lists.append(postings)
+            lists.sort(key=len)
+            docs = set(lists[0][bisect_left(lists[0], self.first):])
+            for postings in lists[1:]:
+                docs.intersection_update(postings)
+                if not docs:
+                    return []
+        else:
+            docs = range(self.first, self.first + len(self.docs))
+        found = []
+        for doc in docs:
+            doc = self.docs[doc - self.first]
+            if kind is not None and doc[0] != kind:
+                continue
+            if start is not None and doc[2] < start:
+                continue
+            if end is not None and doc[2] >= end:
+                continue
+            found.append(doc)
+        found.sort(key=lambda doc: doc[2], reverse=True)
+        return found
+
+    def _prune(self):
+        for token in list(self.postings):
+            postings = self.postings[token]
+            index = bisect_left(postings, self.first)
+            if index == len(postings):
+                del self.postings[token]
+            elif index:
+                del postings[:index]
+        self._evicted = 0
+
+
+class NSSearch:
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.settings = dataIO.load_json("data/nssearch/settings.json")
+        # Saved documents are indexed in the background; until then, this
+        # only holds what was fetched since
+        self.index = Index(self.settings["LIMIT"])
+        self._loaded = False
+        self._dirty = False
+        self.task = bot.loop.create_task(self._save_loop())
+
+    def __unload(self):
+        self.task.cancel()
+        if self._loaded:
+            self._save(self._documents())
+
+    @commands.command(pass_context=True)
+    # API requests: 0; non-API requests: 0
+    async def nssearch(self, ctx, *terms):
+        """Searches happenings and RMB posts the bot has already fetched
+
+        Words must all appear in a result. Filters:
+        nation:NAME region:NAME type:happening type:post
+        since:YYYY-MM-DD until:YYYY-MM-DD
+
+        Only happenings and messages shards fetched by other commands are
+        searched; this makes no API requests."""
+        if not terms:
+            return await send_cmd_help(ctx)
+        if NSApi is None:
+            raise RuntimeError(
+                "NSApi cog is not installed. Please install it:\n"
+                "{p}cog install NationCogs nsapi\n"
+                "Then reload this cog: {p}reload nssearch".format(
+                    p=ctx.prefix))
+        tokens, kind, start, end = [], None, None, None
+        for term in terms:
+            key, _, value = term.lower().partition(":")
+            if not value:
+                tokens.extend(WORD.findall(key))
+            elif key == "nation":
+                tokens.append("@" + NSApi.canonical(value))
+            elif key == "region":
+                tokens.append("%" + NSApi.canonical(value))
+            elif key == "type" and value in ("happening", "post"):
+                kind = value
+            elif key in ("since", "until"):
+                try:
+                    date = datetime.strptime(value, "%Y-%m-%d").replace(
+                        tzinfo=timezone.utc).timestamp()
+                except ValueError:
+                    raise commands.BadArgument(
+                        "Dates must be written as YYYY-MM-DD.")
+                if key == "since":
+                    start = date
+                else:
+                    end = date + 86400
+            else:
+                tokens.extend(WORD.findall(term.lower()))
+        start_time = perf_counter()
+        found = self.index.search(tokens, kind, start, end)
+        elapsed = perf_counter() - start_time
+        if not found:
+            return await self.bot.say("No results in {} indexed "
+                                      "documents.".format(len(self.index)))
+        lines = []
+        for kind, _, timestamp, text, _, _ in found[:10]:
+            text = " ".join(_clean(text).split())
+            lines.append("{} {}: {}".format(
+                datetime.utcfromtimestamp(timestamp).strftime(
+                    "%Y-%m-%d %H:%M"),
+                "H" if kind == "happening" else "P",
+                text if len(text) <= 150 else text[:149] + "…"))
+        await self.bot.say("{} results in {:.1f}ms{}{}".format(
+            len(found), 1e3 * elapsed,
+            ", showing the newest 10" if len(found) > 10 else "",
+            box("\n".join(lines))))
+
+    @commands.command()
+    @checks.is_owner()
+    # API requests: 0; non-API requests: 0
+    async def nssearchlimit(self, limit: int=None):
+        """Gets or sets how many documents the search index retains"""
+        if limit is not None:
+            if limit < 100:
+                return await self.bot.say("The limit must be at least 100.")
+            self.settings["LIMIT"] = self.index.limit = limit
+            dataIO.save_json("data/nssearch/settings.json", self.settings)
+        await self.bot.say("Retaining up to {} documents ({} indexed).".format(
+            self.index.limit, len(self.index)))
+
+    async def on_ns_response(self, api, value, data):
+        # NSApi passes nation and region names in canonical form
+        region = value if api == "region" else None
+        nation = value if api == "nation" else None
+        for event in _items(data.get("happenings"), "event"):
+            if not event.get("text"):
+                continue
+            self._add("happening", event.get("id") or "{}:{}".format(
+                event.get("timestamp"), zlib.crc32(event["text"].encode())),
+                int(event.get("timestamp") or 0), event["text"], region,
+                nation)
+        for post in _items(data.get("messages"), "post"):
+            if post.get("id"):
+                self._add("post", post["id"], int(post.get("timestamp") or 0),
+                          post.get("message") or "", region,
+                          post.get("nation"))
+
+    def _add(self, kind, source, timestamp, text, region=None, nation=None):
+        if self.index.add(*_document(kind, source, timestamp, text, region,
+                                     nation)):
+            self._dirty = True
+
+    async def _save_loop(self):
+        try:
+            try:
+                index = await self.bot.loop.run_in_executor(None, self._load)
+            except CancelledError:
+                raise
+            except Exception as e:
+                # Carry on with what has been fetched since; the saved
+                # documents are overwritten at the next save
+                print("NSSearch: could not load documents: {!r}".format(e))
+            else:
+                # Add what was fetched while loading
+                for doc in self.index.docs:
+                    index.add(*_document(*doc))
+                self.index = index
+            self._loaded = True
+            while True:
+                await sleep(900)
+                if not self._dirty:
+                    continue
+                try:
+                    await self.bot.loop.run_in_executor(
+                        None, self._save, self._documents())
+                except CancelledError:
+                    raise
+                except Exception as e:
+                    self._dirty = True
+                    print("NSSearch: could not save documents: {!r}".format(
+                        e))
+        except CancelledError:
+            pass
+
+    def _documents(self):
+        # Copied on the event loop, as on_ns_response changes the index
+        self._dirty = False
+        return [list(doc) for doc in self.index.docs]
+
+    def _save(self, docs):
+        dataIO.save_json("data/nssearch/documents.json", docs)
+
+    def _load(self):
+        # Runs in the default executor
+        index = Index(self.settings["LIMIT"])
+        for doc in dataIO.load_json("data/nssearch/documents.json"):
+            index.add(*_document(*doc))
+        return index
+
+
+def _document(kind, source, timestamp, text, region=None, nation=None):
+    # Returns a document and its tokens, for Index.add
+    if nation:
+        nation = NSApi.canonical(nation)
+    tokens = set()
+    for name in NATION.findall(text):
+        tokens.add("@" + NSApi.canonical(name))
+    for name in REGION.findall(text):
+        tokens.add("%" + NSApi.canonical(name))
+    if region:
+        tokens.add("%" + region)
+    if nation:
+        tokens.add("@" + nation)
+    tokens.update(WORD.findall(_clean(text).lower()))
+    return (kind, str(source), timestamp, text, region, nation), sorted(tokens)
+
+
+def _items(container, key):
+    if not container:
+        return ()
+    items = container.get(key) if isinstance(container, dict) else None
+    if items is None:
+        return ()
+    if isinstance(items, dict):
+        return (items,)
+    return items
+
+
+def _name(match):
+    return match.group(1).replace("_", " ")
+
+
+def _clean(text):
+    return TAG.sub(" ", unescape(REGION.sub(_name, NATION.sub(_name, text))))
+
+
+def check_folders():
+    fol = "data/nssearch"
+    if not os.path.exists(fol):
+        print("Creating {} folder...".format(fol))
+        os.makedirs(fol)
+
+
+def check_files():
+    fil = "data/nssearch/settings.json"
+    if not dataIO.is_valid_json(fil):
+        print("Creating default {}...".format(fil))
+        dataIO.save_json(fil, {"LIMIT": 50000})
+    fil = "data/nssearch/documents.json"
+    if not dataIO.is_valid_json(fil):
+        print("Creating default {}...".format(fil))
+        dataIO.save_json(fil, [])
+
+
+def setup(bot):
+    if timed_setup is None:
+        check_folders()
+        check_files()
+        bot.add_cog(NSSearch(bot))
+    else:
+        timed_setup(bot, NSSearch, _IMPORT_TIME, check_folders, check_files)
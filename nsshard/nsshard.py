@@ -1,3 +1,6 @@
+from time import perf_counter
+_IMPORT_START = perf_counter()
+
 import os
 from random import choice
 
@@ -9,6 +12,15 @@ from cogs.utils import checks
 
 from .utils.dataIO import dataIO
 
+try:
+    from .nsapi import timed_setup
+except ImportError:
+    # NSApi isn't installed; the cog still loads, and its commands say
+    # how to install it
+    timed_setup = None
+
+_IMPORT_TIME = perf_counter() - _IMPORT_START
+
 
 class NSShard:
 
@@ -52,8 +64,10 @@ class NSShard:
         self._checks(ctx.prefix)
         if nation[0] == nation[-1] and nation.startswith('"'):
             nation = nation[1:-1]
-        data = await self.nsapi.api(*shards, nation=nation)
+        data = await self.nsapi.api_texts(*shards, nation=nation, ctx=ctx)
+        start = perf_counter()
         strdata = self._dict_format('\n', data)
+        self.nsapi.log_format("nation", nation, perf_counter() - start)
         if len(strdata) > self.limit:
             format_str = "```{}...```\n\nToo much data. You may view the " \
                          "rest of this data here:\n\nhttps://www." \
@@ -82,8 +96,10 @@ class NSShard:
         self._checks(ctx.prefix)
         if region[0] == region[-1] and region.startswith('"'):
             region = region[1:-1]
-        data = await self.nsapi.api(*shards, region=region)
+        data = await self.nsapi.api_texts(*shards, region=region, ctx=ctx)
+        start = perf_counter()
         strdata = self._dict_format('\n', data)
+        self.nsapi.log_format("region", region, perf_counter() - start)
         if len(strdata) > self.limit:
             format_str = "```{}...```\n\nToo much data. You may view the " \
                          "rest of this data here:\n\nhttps://www." \
@@ -108,8 +124,10 @@ class NSShard:
             await send_cmd_help(ctx)
             return
         self._checks(ctx.prefix)
-        data = await self.nsapi.api(*shards)
+        data = await self.nsapi.api_texts(*shards, ctx=ctx)
+        start = perf_counter()
         strdata = self._dict_format('\n', data)
+        self.nsapi.log_format("world", None, perf_counter() - start)
         if len(strdata) > self.limit:
             format_str = "```{}...```\n\nToo much data. You may view the " \
                          "rest of this data here:\n\nhttps://www." \
@@ -143,8 +161,10 @@ class NSShard:
         elif council != '1' and council != '2':
             raise TypeError(
                 'Parameter council must be either 1 (GA) or 2 (SC).')
-        data = await self.nsapi.api(*shards, council=council)
+        data = await self.nsapi.api_texts(*shards, council=council, ctx=ctx)
+        start = perf_counter()
         strdata = self._dict_format('\n', data)
+        self.nsapi.log_format("wa", council, perf_counter() - start)
         if len(strdata) > self.limit:
             format_str = "```{}...```\n\nToo much data. You may view the " \
                          "rest of this data here:\n\nhttps://www." \
@@ -155,6 +175,66 @@ class NSShard:
         else:
             await self.bot.say("```{}```".format(strdata))
 
+    @shard.command(name='raw', aliases=['rawgz'], pass_context=True)
+    # API requests: 1; non-API requests: 0
+    async def _shard_raw(self, ctx, api, *args):
+        """Attaches the unformatted XML of any shards as a file
+
+        api is nation, region, world or wa; except for world, it is followed
+        by the nation, the region, or 1/ga or 2/sc. Shard parameters go
+        after the shards as key=value, e.g. census scale=65+66 mode=score.
+        Invoke as rawgz to get the file gzipped.
+
+        Nothing is parsed or formatted, so this is the way to get large
+        shards such as world happenings or WA members."""
+        api = {'n': 'nation', 'r': 'region', 'w': 'world'}.get(
+            api.lower(), api.lower())
+        if api not in ('nation', 'region', 'world', 'wa') or \
+                len(args) < (1 if api == 'world' else 2):
+            await send_cmd_help(ctx)
+            return
+        self._checks(ctx.prefix)
+        kwargs = {}
+        if api != 'world':
+            value, args = args[0], args[1:]
+            if api == 'wa':
+                value = {'ga': '1', 'sc': '2'}.get(value.lower(), value)
+                if value != '1' and value != '2':
+                    raise TypeError(
+                        'Parameter council must be either 1 (GA) or 2 (SC).')
+                kwargs['council'] = value
+            else:
+                kwargs[api] = value = self.nsapi.canonical(value)
+        shards = [arg for arg in args if '=' not in arg]
+        params = dict(arg.split('=', 1) for arg in args if '=' in arg)
+        if not shards:
+            await send_cmd_help(ctx)
+            return
+        if params:
+            shards[-1] = self.nsapi.shard(shards[-1], **params)
+        compress = ctx.invoked_with == 'rawgz'
+        path = 'data/nsshard/{}{}-{}.xml{}'.format(
+            api, '-' + value if kwargs else '', ctx.message.id,
+            '.gz' if compress else '')
+        try:
+            size = await self.nsapi.api_raw(path, *shards, compress=compress,
+                                            ctx=ctx, **kwargs)
+        except ValueError:
+            await self.bot.say('That {} does not exist.'.format(
+                'council' if api == 'wa' else api))
+            return
+        try:
+            await self.bot.send_file(ctx.message.channel, path)
+        except discord.HTTPException:
+            await self.bot.say(
+                'I could not upload the file ({:.1f} MiB). It may be too '
+                'large{}, or I may need the `Attach files` '
+                'permission.'.format(size / 2 ** 20, '' if compress else
+                                     '; try `{}shard rawgz`'.format(
+                                         ctx.prefix)))
+        finally:
+            os.remove(path)
+
     def _dict_format(self, base: str, data: dict):
         join = []
         for key, value in data.items():
@@ -200,5 +280,16 @@ class NSShard:
         self.nsapi.check_agent()
 
 
+def check_folders():
+    fol = "data/nsshard"
+    if not os.path.exists(fol):
+        print("Creating {} folder...".format(fol))
+        os.makedirs(fol)
+
+
 def setup(bot):
-    bot.add_cog(NSShard(bot))
+    if timed_setup is None:
+        check_folders()
+        bot.add_cog(NSShard(bot))
+    else:
+        timed_setup(bot, NSShard, _IMPORT_TIME, check_folders)
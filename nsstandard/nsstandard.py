@@ -1,5 +1,12 @@
+from time import perf_counter
+_IMPORT_START = perf_counter()
+
+import heapq
+import os
+from asyncio import sleep, CancelledError
 from random import randint
 from datetime import datetime
+from time import time
 
 import discord
 from discord.ext import commands
@@ -9,6 +16,15 @@ from cogs.utils import checks
 
 from .utils.dataIO import dataIO
 
+try:
+    from .nsapi import timed_setup
+except ImportError:
+    # NSApi isn't installed; the cog still loads, and its commands say
+    # how to install it
+    timed_setup = None
+
+_IMPORT_TIME = perf_counter() - _IMPORT_START
+
 
 class NSStandard:
 
@@ -16,40 +32,61 @@ class NSStandard:
         self.bot = bot
         self.nsapi = None
         self.illion = ["million", "billion", "trillion", "quadrillion"]
-        # Global flag for Z-Day, since I don't see a way to detect it
-        # automatically
-        self.zday = False
+        self.settings = dataIO.load_json("data/nsstandard/settings.json")
+        # Z-Day detection, from the zombie figures of the sentinel region
+        self.detected = False
+        self.zday_interval = 600
+        # While Z-Day is on, responses this recent are shared by commands
+        self.zday_ttl = 60
+        # Zombie figures of every region fetched during Z-Day, by region:
+        # [survivors, zombies, dead, name, fetched], and their totals
+        self.zombies = {}
+        self.totals = [0, 0, 0]
+        self.task = bot.loop.create_task(self._zday_loop())
+
+    def __unload(self):
+        self.task.cancel()
+
+    @property
+    def zday(self):
+        mode = self.settings["ZDAY"]
+        return self.detected if mode == "auto" else mode == "on"
 
     @commands.command(pass_context=True)
     # API requests: 1; non-API requests: 1
     async def nation(self, ctx, *, nation):
         """Retrieves general info about a specified NationStates nation"""
         self._checks(ctx.prefix)
-        nation.strip("\"")
+        nation = self.nsapi.canonical(nation)
+        zday = self.zday
+        # High-load mode: share responses between commands during Z-Day
+        max_age = self.zday_ttl if zday else None
         try:
             data = await self.nsapi.api("category", "demonym2plural", "flag",
                                         "founded", "freedom", "fullname",
                                         "influence", "lastactivity", "motto",
                                         "population", "region", "wa", "zombie"
-                                        if self.zday else "fullname",
+                                        if zday else "fullname",
                                         self.nsapi.shard("census",
                                                          scale="65+66",
                                                          mode="score"),
-                                        nation=nation)
-        except ValueError:
+                                        nation=nation, ctx=ctx,
+                                        max_age=max_age)
+        except ValueError as e:
             embed = discord.Embed(title=nation.replace("_", " ").title(),
                                   url="https://www.nationstates.net/page="
-                                  "boneyard?nation={}".format(nation.replace(
-                                      " ", "_").lower()),
-                                  description="This nation does not exist.")
+                                  "boneyard?nation={}".format(nation),
+                                  description="This nation does not exist."
+                                  "{}".format(_suggestions(e, "nation")))
             embed.set_author(name="NationStates",
                              url="https://www.nationstates.net/")
             embed.set_thumbnail(url="http://i.imgur.com/Pp1zO19.png")
             try:
                 return await self.bot.say(embed=embed)
             except discord.HTTPException:
-                await self.bot.say(
+                return await self.bot.say(
                     "I need the `Embed links` permission to send this")
+        start = perf_counter()
         endo = int(float(data["census"]["scale"][1]["score"]))
         if endo == 1:
             endo = "{:d} endorsement".format(endo)
@@ -63,14 +100,14 @@ class NSStandard:
             description="[{}](https://www.nationstates.net/region={})"
                         " | {} {} | Founded {}".format(
                             data["region"],
-                            data["region"].lower().replace(" ", "_"),
+                            self.nsapi.canonical(data["region"]),
                             self._illion(data["population"]),
                             data["demonym2plural"], data["founded"]),
-            colour=0x8bbc21 if self.zday else randint(0, 0xFFFFFF))
-        embed.set_author(name="NationStates Z-Day" if self.zday else
+            colour=0x8bbc21 if zday else randint(0, 0xFFFFFF))
+        embed.set_author(name="NationStates Z-Day" if zday else
                          "NationStates", url="https://www.nationstates.net/")
         embed.set_thumbnail(url=data["flag"])
-        if self.zday:
+        if zday:
             embed.add_field(
                 name="{}{}".format(
                     (data["zombie"]["zaction"] or "No Action").title(),
@@ -84,11 +121,13 @@ class NSStandard:
             data["freedom"]["civilrights"], data["freedom"]["economy"],
             data["freedom"]["politicalfreedom"]), inline=False)
         embed.add_field(name=data["unstatus"],
-                        value="{} | {:d} influence ({})".format(
-                            endo,
+                        value="{}{} | {:d} influence ({}){}".format(
+                            endo, self._rank(data["id"], 66),
                             int(float(data["census"]["scale"][0]["score"])),
-                            data["influence"]), inline=False)
+                            data["influence"], self._rank(data["id"], 65)),
+                        inline=False)
         embed.set_footer(text="Last active {}".format(data["lastactivity"]))
+        self.nsapi.log_format("nation", nation, perf_counter() - start)
         try:
             await self.bot.say(embed=embed)
         except discord.HTTPException:
@@ -100,21 +139,27 @@ class NSStandard:
     async def region(self, ctx, *, region):
         """Retrieves general info about a specified NationStates region"""
         self._checks(ctx.prefix)
-        region.strip("\"")
+        region = self.nsapi.canonical(region)
+        zday = self.zday
+        # High-load mode: share responses between commands during Z-Day
+        max_age = self.zday_ttl if zday else None
         try:
             data = await self.nsapi.api("delegate", "delegateauth", "flag",
                                         "founded", "founder", "lastupdate",
                                         "name", "numnations", "power", "zombie"
-                                        if self.zday else "name", region=region)
-        except ValueError:
+                                        if zday else "name",
+                                        region=region, ctx=ctx,
+                                        max_age=max_age)
+        except ValueError as e:
             embed = discord.Embed(title=region.replace("_", " ").title(),
-                                  description="This region does not exist.")
+                                  description="This region does not exist."
+                                  "{}".format(_suggestions(e, "region")))
             embed.set_author(name="NationStates",
                              url="https://www.nationstates.net/")
             try:
                 return await self.bot.say(embed=embed)
             except discord.HTTPException:
-                await self.bot.say(
+                return await self.bot.say(
                     "I need the `Embed links` permission to send this")
         if data["delegate"] == "0":
             data["delegate"] = "No Delegate"
@@ -123,7 +168,8 @@ class NSStandard:
                                            self.nsapi.shard(
                                                "census", scale="65+66",
                                                mode="score"),
-                                           nation=data["delegate"])
+                                           nation=data["delegate"], ctx=ctx,
+                                           max_age=max_age)
             endo = int(float(deldata["census"]["scale"][1]["score"]))
             if endo == 1:
                 endo = "{:d} endorsement".format(endo)
@@ -148,11 +194,13 @@ class NSStandard:
             try:
                 data["founder"] = "[{}](https://www.nationstates.net/" \
                                   "nation={})".format((await self.nsapi.api(
-                                      "fullname", nation=data["founder"]))
+                                      "fullname", nation=data["founder"],
+                                      ctx=ctx, max_age=max_age))
                                       ["fullname"], data["founder"])
             except ValueError:
                 data["founder"] = "{} (Ceased to Exist)".format(
                     data["founder"].replace("_", " ").capitalize())
+        start = perf_counter()
         embed = discord.Embed(
             title=data["name"],
             url="https://www.nationstates.net/region={}".format(data["id"]),
@@ -160,12 +208,12 @@ class NSStandard:
                         "/page=list_nations) | Founded {} | Power: {}".format(
                             data["numnations"], data["id"], data["founded"],
                             data["power"]),
-            colour=0x8bbc21 if self.zday else randint(0, 0xFFFFFF))
-        embed.set_author(name="NationStates Z-Day" if self.zday else
+            colour=0x8bbc21 if zday else randint(0, 0xFFFFFF))
+        embed.set_author(name="NationStates Z-Day" if zday else
                          "NationStates", url="https://www.nationstates.net/")
         if data["flag"]:
             embed.set_thumbnail(url=data["flag"])
-        if self.zday:
+        if zday:
             embed.add_field(
                 name="Zombies",
                 value="Survivors: {} | Zombies: {} | Dead: {}".format(
@@ -177,12 +225,138 @@ class NSStandard:
             data["delegateauth"]), value=data["delegate"], inline=False)
         embed.set_footer(text="Last Updated: {}".format(
             datetime.utcfromtimestamp(int(data["lastupdate"]))))
+        self.nsapi.log_format("region", region, perf_counter() - start)
         try:
             await self.bot.say(embed=embed)
         except discord.HTTPException:
             await self.bot.say(
                 "I need the `Embed links` permission to send this")
 
+    @commands.command(name="zday", pass_context=True)
+    @checks.is_owner()
+    # API requests: 0; non-API requests: 0
+    async def _zday(self, ctx, mode=None):
+        """Shows or sets whether Z-Day is on: on, off or auto
+
+        In auto mode, Z-Day is detected from the zombie figures of a
+        sentinel region, polled around Halloween."""
+        if mode is not None:
+            mode = mode.lower()
+            if mode not in ("on", "off", "auto"):
+                return await send_cmd_help(ctx)
+            self.settings["ZDAY"] = mode
+            dataIO.save_json("data/nsstandard/settings.json", self.settings)
+        await self.bot.say("Z-Day is {} ({}{}).".format(
+            "on" if self.zday else "off", self.settings["ZDAY"],
+            ", polling {}".format(self.settings["SENTINEL"])
+            if self.settings["ZDAY"] == "auto" and _season() else ""))
+
+    @commands.command(pass_context=True)
+    # API requests: 0; non-API requests: 0
+    async def zombies(self, ctx, stat="zombies"):
+        """Z-Day leaderboard of regions: survivors, zombies or dead
+
+        Made from every region fetched by the bot during Z-Day, so it makes
+        no API requests; regions nobody has looked up are not included."""
+        stats = ("survivors", "zombies", "dead")
+        stat = stat.lower()
+        if stat not in stats:
+            return await send_cmd_help(ctx)
+        if not self.zombies:
+            return await self.bot.say("No Z-Day figures have been seen yet.")
+        column = stats.index(stat)
+        top = heapq.nlargest(10, self.zombies.items(),
+                             key=lambda item: item[1][column])
+        embed = discord.Embed(
+            title="Z-Day: most {}".format(stat),
+            description="\n".join(
+                "{}. [{}](https://www.nationstates.net/region={}) {}".format(
+                    rank, figures[3], region, self._illion(figures[column]))
+                for rank, (region, figures) in enumerate(top, 1)),
+            colour=0x8bbc21)
+        embed.set_author(name="NationStates Z-Day",
+                         url="https://www.nationstates.net/")
+        embed.add_field(
+            name="{} regions".format(len(self.zombies)),
+            value="Survivors: {} | Zombies: {} | Dead: {}".format(
+                *map(self._illion, self.totals)), inline=False)
+        embed.set_footer(text="Oldest figures from {}".format(
+            datetime.utcfromtimestamp(min(
+                figures[4] for figures in self.zombies.values())).strftime(
+                    "%H:%M UTC")))
+        try:
+            await self.bot.say(embed=embed)
+        except discord.HTTPException:
+            await self.bot.say(
+                "I need the `Embed links` permission to send this")
+
+    async def on_ns_response(self, api, value, data):
+        # Adds up the zombie figures of every region anyone fetches
+        zombie = data.get("zombie")
+        if api != "region" or not isinstance(zombie, dict) or not self.zday:
+            return
+        figures = [int(zombie.get(stat) or 0)
+                   for stat in ("survivors", "zombies", "dead")]
+        old = self.zombies.get(value)
+        for i in range(3):
+            self.totals[i] += figures[i] - (old[i] if old else 0)
+        self.zombies[value] = figures + [
+            data.get("name") or value.replace("_", " ").title(), time()]
+
+    async def _zday_loop(self):
+        try:
+            await self.bot.wait_until_ready()
+            while True:
+                if self.settings["ZDAY"] == "auto":
+                    try:
+                        self._checks("[p]")
+                        await self._detect()
+                    except CancelledError:
+                        raise
+                    except Exception as e:
+                        print("NSStandard: could not detect Z-Day: "
+                              "{!r}".format(e))
+                await sleep(self.zday_interval if _season() else 3600)
+        except CancelledError:
+            pass
+
+    async def _detect(self):
+        if not _season():
+            self.detected = False
+            return
+        zombie = (await self.nsapi.api(
+            "zombie", region=self.settings["SENTINEL"],
+            background=True))["zombie"]
+        figures = [int(zombie.get(stat) or 0)
+                   for stat in ("survivors", "zombies", "dead")]
+        now = time()
+        # [sentinel, its last figures, when they last changed], saved so
+        # that a restart during Z-Day doesn't lose track of it
+        last = self.settings.get("LAST_POLL")
+        if not last or last[0] != self.settings["SENTINEL"]:
+            # Figures from last Z-Day stay frozen, so only a change seen
+            # between two polls means Z-Day is on
+            last = [self.settings["SENTINEL"], figures, 0]
+        elif figures != last[1]:
+            last = [self.settings["SENTINEL"], figures, now]
+        if last != self.settings.get("LAST_POLL"):
+            self.settings["LAST_POLL"] = last
+            dataIO.save_json("data/nsstandard/settings.json", self.settings)
+        zday = now - last[2] < 3 * 3600 and (figures[1] > 0 or figures[2] > 0)
+        if zday and not self.detected:
+            # Leave last year's figures behind
+            self.zombies.clear()
+            self.totals = [0, 0, 0]
+        self.detected = zday
+
+    def _rank(self, nation: str, scale: int):
+        # Free if NSCensus has the daily world census scores loaded
+        census = self.bot.get_cog("NSCensus")
+        rank = census and census.world_rank(nation, scale)
+        if not rank:
+            return ""
+        return " (#{} world, #{} region)".format(rank[1], rank[2])
+
     def _illion(self, num: str):
         num = int(num)
         index = 0
@@ -202,5 +376,40 @@ class NSStandard:
         self.nsapi.check_agent()
 
 
+def _season():
+    # Z-Day is held around Halloween
+    today = datetime.utcnow()
+    return (10, 25) <= (today.month, today.day) <= (11, 5)
+
+
+def _suggestions(error, kind):
+    # NSApi's NameNotFound carries known names similar to the missing one
+    names = getattr(error, "suggestions", None)
+    if not names:
+        return ""
+    return "\nDid you mean {}?".format(" or ".join(
+        "[{}](https://www.nationstates.net/{}={})".format(
+            name.replace("_", " ").title(), kind, name) for name in names))
+
+
+def check_folders():
+    fol = "data/nsstandard"
+    if not os.path.exists(fol):
+        print("Creating {} folder...".format(fol))
+        os.makedirs(fol)
+
+
+def check_files():
+    fil = "data/nsstandard/settings.json"
+    if not dataIO.is_valid_json(fil):
+        print("Creating default {}...".format(fil))
+        dataIO.save_json(fil, {"ZDAY": "auto", "SENTINEL": "the_pacific"})
+
+
 def setup(bot):
-    bot.add_cog(NSStandard(bot))
+    if timed_setup is None:
+        check_folders()
+        check_files()
+        bot.add_cog(NSStandard(bot))
+    else:
+        timed_setup(bot, NSStandard, _IMPORT_TIME, check_folders, check_files)